@@ -0,0 +1,171 @@
+"""
+Local stand-ins for the Slack WebClient and the Google Calendar service, so the hot paths can be timed without live
+accounts. Both can add latency per call, fail a fraction of calls, and rate limit every Nth call the same way the
+real APIs do (a 429 with Retry-After from Slack, a 403 rateLimitExceeded from Google).
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+import json
+import random
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+from slack_sdk.errors import SlackApiError
+
+
+class FaultInjector(object):
+    """ Shared latency/error/rate limit behaviour, counting calls per method. """
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, rate_limit_every: int = 0, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.rate_limit_every = rate_limit_every
+        self.calls: Dict[str, int] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, method: str) -> str:
+        """ :return: 'ok', 'error' or 'rate_limited' """
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            count = self.calls[method]
+            failed = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit_every and count % self.rate_limit_every == 0:
+            return 'rate_limited'
+        return 'error' if failed else 'ok'
+
+
+class FakeSlackResponse(dict):
+    def __init__(self, data: dict, status_code: int = 200, headers: Optional[dict] = None):
+        super().__init__(data)
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeWebClient(object):
+    """ Implements the WebClient methods MeetingSurveyor uses against an in-memory workspace. """
+    def __init__(self, members: List[dict], faults: FaultInjector):
+        self.members = members
+        self.faults = faults
+        self.messages: List[dict] = []
+        self._lock = threading.Lock()
+
+    def _check(self, method: str) -> None:
+        outcome = self.faults.call(method)
+        if outcome == 'rate_limited':
+            raise SlackApiError('ratelimited', FakeSlackResponse({'ok': False, 'error': 'ratelimited'}, 429,
+                                                                 {'Retry-After': '0'}))
+        if outcome == 'error':
+            raise SlackApiError('internal_error', FakeSlackResponse({'ok': False, 'error': 'internal_error'}, 500))
+
+    def chat_postMessage(self, channel: str, text: str, **kwargs) -> FakeSlackResponse:
+        self._check('chat_postMessage')
+        with self._lock:
+            self.messages.append({'channel': channel, 'text': text})
+        return FakeSlackResponse({'ok': True, 'channel': channel, 'ts': str(time.time())})
+
+    def users_list(self, limit: int = 200, cursor: Optional[str] = None, **kwargs) -> FakeSlackResponse:
+        self._check('users_list')
+        start = int(cursor or 0)
+        page = self.members[start:start + limit]
+        next_cursor = str(start + limit) if start + limit < len(self.members) else ''
+        return FakeSlackResponse({'ok': True, 'members': page, 'response_metadata': {'next_cursor': next_cursor}})
+
+
+def slack_members(num_users: int, deleted_every: int = 50) -> List[dict]:
+    return [{
+        'id': f'U{i:08d}',
+        'is_bot': False,
+        'deleted': bool(deleted_every) and i % deleted_every == 0,
+        'profile': {'email': f'user{i}@example.com'},
+    } for i in range(1, num_users + 1)]
+
+
+def google_event(google_id: str, organizer_email: str, attendee_emails: List[str], start: datetime) -> dict:
+    def iso(value: datetime) -> str:
+        return value.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+    return {
+        'id': google_id,
+        'status': 'confirmed',
+        'etag': f'"{google_id}-1"',
+        'summary': f'Meeting {google_id}',
+        'description': 'Agenda for the week, please come prepared. ──────\nJoin Zoom Meeting',
+        'created': (start - timedelta(days=7)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'start': {'dateTime': iso(start)},
+        'end': {'dateTime': iso(start + timedelta(minutes=30))},
+        'organizer': {'email': organizer_email},
+        'attendees': [{'email': e, 'responseStatus': 'accepted'} for e in attendee_emails],
+    }
+
+
+class _Request(object):
+    def __init__(self, execute):
+        self.headers = {}
+        self._execute = execute
+
+    def execute(self) -> dict:
+        return self._execute(self.headers)
+
+
+class FakeCalendarService(object):
+    """
+    Implements events().list and events().get for a set of calendars, keyed by the email of the user whose service it
+    is. Supports pagination, sync tokens (an incremental sync returns the events marked as changed) and If-None-Match
+    on events().get.
+    """
+    def __init__(self, calendars: Dict[str, List[dict]], faults: FaultInjector, page_size: int = 250):
+        self.calendars = calendars
+        self.faults = faults
+        self.page_size = page_size
+        self.changed: Dict[str, List[dict]] = {}
+        self.email = None
+
+    def for_user(self, email: str) -> 'FakeCalendarService':
+        service = FakeCalendarService(self.calendars, self.faults, self.page_size)
+        service.changed = self.changed
+        service.email = email
+        return service
+
+    def _check(self, method: str) -> None:
+        outcome = self.faults.call(method)
+        if outcome == 'ok':
+            return
+        status, reason = (403, 'rateLimitExceeded') if outcome == 'rate_limited' else (500, 'backendError')
+        content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}], 'message': reason}})
+        raise HttpError(httplib2.Response({'status': status}), content.encode())
+
+    def events(self) -> 'FakeCalendarService':
+        return self
+
+    def list(self, calendarId: str = 'primary', pageToken: Optional[str] = None, syncToken: Optional[str] = None,
+             fields: Optional[str] = None, maxResults: Optional[int] = None, **kwargs) -> _Request:
+        page_size = min(self.page_size, maxResults or self.page_size)
+
+        def execute(headers: dict):
+            self._check('events.list')
+            items = self.changed.get(self.email, []) if syncToken else self.calendars.get(self.email, [])
+            start = int(pageToken or 0)
+            # Copies, since callers add parsed fields to the events they get back.
+            response = {'items': [dict(e) for e in items[start:start + page_size]]}
+            if start + page_size < len(items):
+                response['nextPageToken'] = str(start + page_size)
+            else:
+                response['nextSyncToken'] = f'sync-{self.email}'
+            return response
+        return _Request(execute)
+
+    def get(self, calendarId: str = 'primary', eventId: Optional[str] = None, **kwargs) -> _Request:
+        def execute(headers: dict):
+            self._check('events.get')
+            for event in self.calendars.get(self.email, []):
+                if event['id'] == eventId:
+                    if headers.get('If-None-Match') == event['etag']:
+                        raise HttpError(httplib2.Response({'status': 304}), b'')
+                    return dict(event)
+            raise HttpError(httplib2.Response({'status': 404}), b'{"error": {"code": 404}}')
+        return _Request(execute)
@@ -0,0 +1,106 @@
+"""
+Shows the query plans and timings of the hot-path queries against a synthetic database, with and without the indexes
+from db/migrations.py. Run from the repo root:
+
+    python3 -m benchmarks.query_plans --events 100000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text, and_
+from sqlalchemy.orm import sessionmaker
+
+from db.database import Base, Event, SurveyResponse, User
+
+# The indexes the hot queries below can use, dropped for the "without" run. Keep this up to date when adding indexes
+# on these tables. Users are looked up by their unique email_address and slack_id in both runs.
+INDEXES = ['ix_survey_responses_event_id_user_id', 'ix_events_google_event_id', 'ix_events_pending_questions',
+           'ix_events_pending_results', 'ix_events_pending_notifications', 'ix_events_end_datetime']
+
+
+def seed(session, num_users: int, num_events: int, responses_per_event: int) -> None:
+    now = datetime.utcnow()
+    session.bulk_insert_mappings(User, [
+        {'id': i, 'slack_id': f'U{i:08d}', 'email_address': f'user{i}@example.com'} for i in range(1, num_users + 1)
+    ])
+    events = []
+    for i in range(1, num_events + 1):
+        end = now - timedelta(minutes=random.randint(-2 * 24 * 60, 365 * 24 * 60))
+        sent = end < now - timedelta(days=1)
+        events.append({
+            'id': i, 'google_event_id': f'g{i:010d}', 'name': f'Meeting {i}',
+            'organizer_id': random.randint(1, num_users),
+            'organizer_email': 'organizer@example.com', 'start_datetime': end - timedelta(hours=1),
+            'end_datetime': end, 'should_send_survey': True, 'survey_questions_sent': sent,
+            'survey_results_sent': sent, 'notification_sent': end < now, 'source_user_id': 1, 'num_attendees': 5,
+        })
+    session.bulk_insert_mappings(Event, events)
+    session.bulk_insert_mappings(SurveyResponse, [
+        {'event_id': e, 'user_id': random.randint(1, num_users), 'response': random.choice(['yes', 'no', 'maybe'])}
+        for e in range(1, num_events + 1) for _ in range(responses_per_event)
+    ])
+    session.commit()
+
+
+def hot_queries(session):
+    now = datetime.utcnow()
+    return {
+        'event by google_event_id': session.query(Event).filter_by(google_event_id='g0000000007'),
+        'user by email_address': session.query(User).filter_by(email_address='user7@example.com'),
+        'user by slack_id': session.query(User).filter_by(slack_id='U00000007'),
+        'responses for event': session.query(SurveyResponse).filter_by(event_id=7),
+        'response for event and user': session.query(SurveyResponse).filter_by(event_id=7, user_id=7),
+        'pending questions': session.query(Event).filter(and_(
+            Event.survey_questions_sent.is_(False), Event.should_send_survey.is_(True))),
+        'pending results': session.query(Event).filter(and_(
+            Event.survey_results_sent.is_(False), Event.survey_questions_sent.is_(True),
+            Event.end_datetime < now - timedelta(hours=1))),
+        'pending notifications': session.query(Event).filter(and_(
+            Event.notification_sent.is_(False), Event.start_datetime <= now + timedelta(days=1))),
+    }
+
+
+def report(session, label: str, repeat: int) -> None:
+    print(f'\n== {label} ==')
+    for name, query in hot_queries(session).items():
+        statement = query.statement.compile(session.bind, compile_kwargs={'literal_binds': True})
+        plan = session.execute(text(f'EXPLAIN QUERY PLAN {statement}')).fetchall()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            query.all()
+        elapsed_ms = (time.perf_counter() - start) / repeat * 1000
+        print(f'{name:<30} {elapsed_ms:9.3f} ms  {"; ".join(row[-1] for row in plan)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--responses-per-event', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f'sqlite:///{os.path.join(tmp, "bench.db")}')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        seed(session, args.users, args.events, args.responses_per_event)
+
+        for index in INDEXES:
+            session.execute(text(f'DROP INDEX {index}'))
+        session.execute(text('ANALYZE'))
+        session.commit()
+        report(session, 'without indexes', args.repeat)
+        session.commit()
+
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in INDEXES:
+                    index.create(engine)
+        session.execute(text('ANALYZE'))
+        session.commit()
+        report(session, 'with indexes', args.repeat)
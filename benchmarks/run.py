@@ -0,0 +1,273 @@
+"""
+Offline benchmarks for the hot paths, run against a synthetic SQLite database with local stand-ins for Slack and
+Google Calendar (see benchmarks/fakes.py). Results are printed and optionally written as JSON, tagged with the current
+commit, so runs can be compared between commits. Run from the repo root:
+
+    python3 -m benchmarks.run --output bench.json
+    python3 -m benchmarks.run --users 10000 --events 200000 --responses 1000000 --google-latency-ms 50
+"""
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000, help='Slack users in the directory')
+    parser.add_argument('--events', type=int, default=200000, help='Historic events already in the DB')
+    parser.add_argument('--responses', type=int, default=1000000, help='Survey responses on historic events')
+    parser.add_argument('--connected-users', type=int, default=500, help='Users with a Google calendar connected')
+    parser.add_argument('--events-per-calendar', type=int, default=20)
+    parser.add_argument('--attendees-per-event', type=int, default=5)
+    parser.add_argument('--changed-fraction', type=float, default=0.05,
+                        help='Fraction of each calendar returned as changed on an incremental sync')
+    parser.add_argument('--pending', type=int, default=1000, help='Events waiting on questions, and on results')
+    parser.add_argument('--replies', type=int, default=1000, help='Survey replies to handle')
+    parser.add_argument('--slack-latency-ms', type=float, default=0)
+    parser.add_argument('--google-latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of Slack and Google calls which fail')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='Rate limit every Nth call to each method')
+    parser.add_argument('--slack-rate-per-minute', type=float, default=1e9,
+                        help="Override the dispatcher's Slack rate limits, per method and per channel")
+    parser.add_argument('--google-rate-per-minute', type=float, default=1e9,
+                        help="Override the Google project and per-user quotas, default effectively unlimited")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    return parser.parse_args()
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed_database(engine, args, rng: random.Random):
+    """ Bulk load users, historic events and responses, plus the events pending questions and results. """
+    from db.database import User, Event, SurveyResponse
+    from sqlalchemy import text
+    from src.rollups import description_stats, meeting_stats, rebuild_rollups
+
+    now = datetime.utcnow()
+
+    def insert(table, rows):
+        with engine.begin() as connection:
+            for start in range(0, len(rows), 50000):
+                connection.execute(table.insert(), rows[start:start + 50000])
+
+    insert(User.__table__, [{
+        'id': i, 'slack_id': f'U{i:08d}', 'email_address': f'user{i}@example.com', 'has_opted_out': False,
+        'is_deleted': False, 'refresh_token': f'1//bench-{i}' if i <= args.connected_users else None,
+    } for i in range(1, args.users + 1)])
+
+    def event(event_id, end, questions_sent, results_sent):
+        organizer = rng.randint(1, args.users)
+        attendees = [organizer] + rng.sample(range(1, args.users + 1), args.attendees_per_event - 1)
+        description = 'Agenda. Join Zoom Meeting'
+        return {
+            'id': event_id, 'google_event_id': f'hist{event_id:010d}', 'name': f'Meeting {event_id}',
+            'organizer_id': organizer, 'organizer_email': f'user{organizer}@example.com',
+            'created_at_datetime': end - timedelta(days=7), 'start_datetime': end - timedelta(minutes=30),
+            'end_datetime': end, 'should_send_survey': True, 'survey_questions_sent': questions_sent,
+            'survey_results_sent': results_sent, 'description': description,
+            'source_user_id': organizer, 'num_attendees': len(attendees),
+            'attendees': [{'email': f'user{a}@example.com', 'responseStatus': 'accepted'} for a in attendees],
+            **meeting_stats(end - timedelta(minutes=30), end, len(attendees)),
+            **description_stats(description, has_conference=True),
+        }
+
+    events = [event(i, now - timedelta(minutes=rng.randint(24 * 60, 365 * 24 * 60)), True, True)
+              for i in range(1, args.events + 1)]
+    pending_questions = list(range(args.events + 1, args.events + args.pending + 1))
+    pending_results = list(range(pending_questions[-1] + 1, pending_questions[-1] + args.pending + 1)) \
+        if args.pending else []
+    events += [event(i, now - timedelta(minutes=5), False, False) for i in pending_questions]
+    events += [event(i, now - timedelta(hours=2), True, False) for i in pending_results]
+    insert(Event.__table__, events)
+
+    insert(SurveyResponse.__table__, [{
+        'event_id': rng.randint(1, args.events), 'user_id': rng.randint(1, args.users),
+        'response': rng.choice(['yes', 'no', 'maybe']),
+    } for _ in range(args.responses)])
+    # A few responses on each event whose results are pending, so there's something to send.
+    insert(SurveyResponse.__table__, [{
+        'event_id': event_id, 'user_id': rng.randint(1, args.users), 'response': rng.choice(['yes', 'no', 'maybe']),
+    } for event_id in pending_results for _ in range(3)])
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            'INSERT INTO survey_tallies (event_id, response, count) '
+            'SELECT event_id, response, COUNT(*) FROM survey_responses GROUP BY event_id, response'
+        ))
+        rebuild_rollups(connection)
+        # The users who'll reply are waiting on one of the events whose results are pending.
+        for user_id in range(1, min(args.replies, args.users) + 1):
+            if pending_results:
+                connection.execute(text('UPDATE users SET awaiting_response_on = :event_id WHERE id = :user_id'),
+                                   {'event_id': rng.choice(pending_results), 'user_id': user_id})
+
+
+def build_calendars(args, rng: random.Random):
+    """ Meetings shared between connected users, each showing up in every attendee's calendar. """
+    from benchmarks.fakes import google_event
+
+    connected = [f'user{i}@example.com' for i in range(1, args.connected_users + 1)]
+    calendars = {email: [] for email in connected}
+    num_meetings = args.connected_users * args.events_per_calendar // args.attendees_per_event
+    start = datetime.utcnow() + timedelta(hours=2)
+    for i in range(num_meetings):
+        attendees = rng.sample(connected, min(args.attendees_per_event, len(connected)))
+        meeting = google_event(f'bench{i:010d}', attendees[0], attendees, start + timedelta(minutes=30 * (i % 48)))
+        for email in attendees:
+            calendars[email].append(meeting)
+    return calendars
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    tmp = tempfile.TemporaryDirectory()
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(tmp.name, "bench.db")}'
+    os.environ.setdefault('HOST', 'https://bench.example.com')
+    os.environ.setdefault('SLACK_OAUTH_TOKEN', 'xoxb-bench')
+
+    # Imported after DATABASE_URL is set, db.database reads it at import time.
+    from benchmarks.fakes import FaultInjector, FakeWebClient, FakeCalendarService, slack_members
+    from db.database import get_engine, remove_session
+    from src import google_scheduler, slack_dispatcher
+    from src.calendar_api_wrapper import CalendarAPIWrapper
+    from src.meeting_surveyor import MeetingSurveyor
+    from src.outbox import get_outbox
+
+    for method in slack_dispatcher.METHOD_RATE_LIMITS:
+        slack_dispatcher.METHOD_RATE_LIMITS[method] = (args.slack_rate_per_minute, 1000)
+    slack_dispatcher.DEFAULT_RATE_LIMIT = (args.slack_rate_per_minute, 1000)
+    for method in slack_dispatcher.CHANNEL_RATE_LIMITS:
+        slack_dispatcher.CHANNEL_RATE_LIMITS[method] = (args.slack_rate_per_minute, 1000)
+    google_scheduler.google_scheduler.project = google_scheduler.PriorityGate(args.google_rate_per_minute, 1000)
+    google_scheduler.google_scheduler.user_rate = args.google_rate_per_minute
+    google_scheduler.google_scheduler.user_burst = 1000
+    slack_faults = FaultInjector(args.slack_latency_ms, args.error_rate, args.rate_limit_every, args.seed)
+    google_faults = FaultInjector(args.google_latency_ms, args.error_rate, args.rate_limit_every, args.seed)
+    members = slack_members(args.users + args.users // 100)  # 1% of the directory is new
+    slack_dispatcher._dispatcher = slack_dispatcher.SlackDispatcher(FakeWebClient(members, slack_faults))
+    calendars = build_calendars(args, rng)
+    calendar_service = FakeCalendarService(calendars, google_faults)
+
+    class OfflineCalendarAPIWrapper(CalendarAPIWrapper):
+        def get_service(self, user, priority=None):
+            return calendar_service.for_user(user.email_address)
+
+    def surveyor() -> MeetingSurveyor:
+        ms = MeetingSurveyor()
+        ms.calendar = OfflineCalendarAPIWrapper()
+        return ms
+
+    print('Seeding database...', file=sys.stderr)
+    started = time.perf_counter()
+    seed_database(get_engine(), args, rng)
+    print(f'Seeded in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+    results = {}
+
+    def timed(name, operations, fn):
+        """ Time fn, counting operations, or whatever fn returns when operations is None. """
+        slack_calls, google_calls = sum(slack_faults.calls.values()), sum(google_faults.calls.values())
+        started = time.perf_counter()
+        try:
+            returned = fn()
+        finally:
+            remove_session()
+        seconds = time.perf_counter() - started
+        if operations is None:
+            operations = returned
+        results[name] = {
+            'seconds': round(seconds, 4),
+            'operations': operations,
+            'operations_per_second': round(operations / seconds, 2) if seconds else None,
+            'slack_calls': sum(slack_faults.calls.values()) - slack_calls,
+            'google_calls': sum(google_faults.calls.values()) - google_calls,
+        }
+        print(f'{name:<35} {seconds:9.3f}s  {operations} ops', file=sys.stderr)
+
+    calendar_events = sum(len(c) for c in calendars.values())
+    timed('populate_events.bootstrap', calendar_events,
+          lambda: OfflineCalendarAPIWrapper().populate_events(incremental=True))
+    for email, events in calendars.items():
+        calendar_service.changed[email] = events[:max(1, int(len(events) * args.changed_fraction))]
+    changed_events = sum(len(c) for c in calendar_service.changed.values())
+    timed('populate_events.incremental', changed_events,
+          lambda: OfflineCalendarAPIWrapper().populate_events(incremental=True))
+
+    from db.database import get_session, Event
+    detail_ids = [row.id for row in get_session().query(Event.id).filter(Event.google_event_id.like('bench%'))
+                  .limit(args.pending)]
+    remove_session()
+
+    def event_details():
+        cal = OfflineCalendarAPIWrapper()
+        for event_id in detail_ids:
+            cal.get_event_google_details(event_id)
+    timed('get_event_google_details.cold', len(detail_ids), event_details)
+    timed('get_event_google_details.revalidated', len(detail_ids), event_details)
+    timed('populate_slack_users', len(members), lambda: surveyor().populate_slack_users())
+
+    # What a worker's poll_survey_steps and run_survey_step (scheduled.py) do, without the scheduler and leases.
+    deadlines = []
+
+    def due_deadlines():
+        deadlines.extend(surveyor().get_deadlines(due_before=datetime.utcnow()))
+        return len(deadlines)
+    timed('get_deadlines', None, due_deadlines)
+
+    def survey_steps():
+        ms = surveyor()
+        for _, _, event_id in deadlines:
+            for due_at, step, _ in ms.get_deadlines(event_ids=[event_id]):
+                if due_at > datetime.utcnow():
+                    break
+                if step == 'question':
+                    ms.send_survey_question(event_id)
+                else:
+                    ms.send_survey_results(event_id)
+        return len(deadlines)
+    timed('run_survey_step', None, survey_steps)
+
+    def replies():
+        ms = surveyor()
+        for user_id in range(1, min(args.replies, args.users) + 1):
+            ms.handle_survey_submission(f'U{user_id:08d}', rng.choice(['yes', 'no', 'maybe']))
+            remove_session()
+    timed('handle_survey_submission', min(args.replies, args.users), replies)
+
+    from src.rollups import org_report, organizer_report, report_range
+    since, until = report_range(since=(datetime.utcnow() - timedelta(days=365)).date().isoformat())
+    organizers = [f'user{i}@example.com' for i in range(1, min(100, args.users) + 1)]
+    timed('rollups.org_report', 1, lambda: org_report(get_session(), since, until))
+    timed('rollups.organizer_report', len(organizers),
+          lambda: [organizer_report(get_session(), email, since, until) for email in organizers])
+
+    timed('outbox.drain', None, lambda: get_outbox().drain().get('sent', 0))
+
+    report = {
+        'commit': current_commit(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'config': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
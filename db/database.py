@@ -1,14 +1,34 @@
 import os
+import threading
+from datetime import datetime
+from typing import Dict
 
 import sqlalchemy.orm
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, DateTime, Integer, String, Boolean, ForeignKey, UniqueConstraint, JSON
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Date, DateTime, Float, Integer, String, Boolean, ForeignKey, Index, JSON
+from sqlalchemy import UniqueConstraint
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy_utils import create_database, database_exists
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from db.migrations import upgrade, stamp
+from src.metrics import instrument_engine
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///db/meeting_surveyor.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+# How long SQLite waits on a lock held by another connection/process before raising "database is locked".
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+# Set to NORMAL to skip an fsync per commit, safe with WAL but the last commits may be lost on power failure.
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS')
 
 Base = declarative_base()
 
+# One engine and one thread-local session registry per database URL for the whole process.
+_engines: Dict[str, Engine] = {}
+_sessions: Dict[str, scoped_session] = {}
+_lock = threading.Lock()
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -17,11 +37,22 @@ class User(Base):
     slack_id = Column(String, nullable=False)
     email_address = Column(String, nullable=False)
     has_opted_out = Column(Boolean, default=False, nullable=False)
+    is_deleted = Column(Boolean, default=False, nullable=False)  # Deactivated in Slack
     refresh_token = Column(String, nullable=True)
+    access_token = Column(String, nullable=True)  # Encrypted, see src/token_store.py
+    # When the access token expires, or when to try refreshing it again after a failure.
+    access_token_expires_at = Column(DateTime(timezone=False), nullable=True)
+    calendar_sync_token = Column(String, nullable=True)  # Google nextSyncToken from the last calendar sync
+    calendar_changed_at = Column(DateTime(timezone=False), nullable=True)  # Push notification not yet synced
     awaiting_response_on = Column(Integer, ForeignKey('events.id'), nullable=True)
 
-    UniqueConstraint(email_address)
-    UniqueConstraint(slack_id)
+    # Keep in sync with db/migrations.py
+    __table_args__ = (
+        UniqueConstraint(email_address),
+        UniqueConstraint(slack_id),
+        Index('ix_users_calendar_changed_at', calendar_changed_at),
+        Index('ix_users_access_token_expires_at', access_token_expires_at),
+    )
 
 
 class SurveyResponse(Base):
@@ -32,6 +63,19 @@ class SurveyResponse(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     response = Column(String, nullable=False)
 
+    __table_args__ = (
+        Index('ix_survey_responses_event_id_user_id', event_id, user_id),
+    )
+
+
+class SurveyTally(Base):
+    """ Number of survey responses per answer for an event, kept up to date as responses come in by src/tallies.py """
+    __tablename__ = 'survey_tallies'
+
+    event_id = Column(Integer, ForeignKey('events.id'), primary_key=True)
+    response = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
 
 class Event(Base):
     __tablename__ = 'events'
@@ -50,14 +94,198 @@ class Event(Base):
     description = Column(String)
     source_user_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # Who we were when we got this event info.
     num_attendees = Column(Integer, nullable=False)  # Who we were when we got this event info.
+    attendees = Column(JSON, nullable=True)  # [{'email': ..., 'responseStatus': ...}] as of the last sync.
+    is_cancelled = Column(Boolean, default=False, nullable=False)
+    # Whether the organizer has been sent the notification about it, see MeetingSurveyor.send_pending_notifications
+    notification_sent = Column(Boolean, default=False, nullable=False)
+    # Derived at ingest, see src/rollups.py
+    duration_minutes = Column(Integer, nullable=True)
+    cost = Column(Float, nullable=True)
+    description_words = Column(Integer, nullable=True)
+    is_zoom = Column(Boolean, nullable=True)
+
+    __table_args__ = (
+        Index('ix_events_google_event_id', google_event_id, unique=True),
+        # Pending scans in MeetingSurveyor.send_pending_questions/send_pending_results/send_pending_notifications
+        Index('ix_events_pending_questions', survey_questions_sent, should_send_survey, end_datetime),
+        Index('ix_events_pending_results', survey_results_sent, survey_questions_sent, end_datetime),
+        Index('ix_events_pending_notifications', notification_sent, start_datetime),
+        # Retention, see src/retention.py
+        Index('ix_events_end_datetime', end_datetime),
+    )
+
+
+class EventSummary(Base):
+    """ What's kept of an event once it and its responses have been moved to an archive file by src/retention.py """
+    __tablename__ = 'event_summaries'
+
+    event_id = Column(Integer, primary_key=True, autoincrement=False)
+    google_event_id = Column(String, nullable=False)
+    name = Column(String)
+    organizer_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    organizer_email = Column(String, nullable=False)
+    start_datetime = Column(DateTime(timezone=False))
+    end_datetime = Column(DateTime(timezone=False))
+    num_attendees = Column(Integer, nullable=False)
+    is_cancelled = Column(Boolean, default=False, nullable=False)
+    duration_minutes = Column(Integer, nullable=True)
+    cost = Column(Float, nullable=True)
+    description_words = Column(Integer, nullable=True)
+    responses = Column(JSON, nullable=False)  # Response -> count
+    archive_file = Column(String, nullable=False)
+    archived_at = Column(DateTime(timezone=False), nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_event_summaries_organizer_id_start_datetime', organizer_id, start_datetime),
+    )
+
+
+class OrganizerWeek(Base):
+    """ Totals of an organizer's meetings starting in a week (Monday, UTC), kept up to date by src/rollups.py """
+    __tablename__ = 'organizer_weeks'
+
+    organizer_email = Column(String, primary_key=True)
+    week_start = Column(Date, primary_key=True)
+    meetings = Column(Integer, nullable=False, default=0)
+    minutes = Column(Integer, nullable=False, default=0)
+    cost = Column(Float, nullable=False, default=0)
+    undescribed_meetings = Column(Integer, nullable=False, default=0)  # Fewer than MIN_DESCRIPTION_WORDS
+
+    __table_args__ = (
+        Index('ix_organizer_weeks_week_start', week_start),
+    )
+
+
+class OrganizerWeekResponse(Base):
+    """ Survey responses to an organizer's meetings starting in a week, kept up to date by src/rollups.py """
+    __tablename__ = 'organizer_week_responses'
+
+    organizer_email = Column(String, primary_key=True)
+    week_start = Column(Date, primary_key=True)
+    response = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_organizer_week_responses_week_start', week_start),
+    )
+
+
+class SyncCheckpoint(Base):
+    """ Where an interrupted paginated sync should pick up from. """
+    __tablename__ = 'sync_checkpoints'
+
+    name = Column(String, primary_key=True)
+    cursor = Column(String, nullable=True)
+    updated_at = Column(DateTime(timezone=False), nullable=False, default=datetime.utcnow)
+
+
+class CalendarChannel(Base):
+    """ A Google Calendar push notification channel watching a user's primary calendar, see src/calendar_watch.py """
+    __tablename__ = 'calendar_channels'
+
+    id = Column(String, primary_key=True)  # Our channel id, sent back to us as X-Goog-Channel-ID
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    resource_id = Column(String, nullable=False)  # Google's id for the watched calendar, needed to stop the channel
+    token = Column(String, nullable=False)  # Secret sent back to us as X-Goog-Channel-Token
+    expires_at = Column(DateTime(timezone=False), nullable=False)
+    created_at = Column(DateTime(timezone=False), nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_calendar_channels_user_id_expires_at', user_id, expires_at),
+    )
+
+
+class Worker(Base):
+    """ A running scheduled.py process, kept alive by its heartbeat. See src/worker_leases.py """
+    __tablename__ = 'workers'
+
+    id = Column(String, primary_key=True)
+    heartbeat_at = Column(DateTime(timezone=False), nullable=False)
+
+
+class WorkerLease(Base):
+    """ Which worker owns a shard of the users and events, and until when. """
+    __tablename__ = 'worker_leases'
+
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String, nullable=True)  # Worker.id, or None if the shard is free
+    expires_at = Column(DateTime(timezone=False), nullable=True)
+
+
+class OutboxMessage(Base):
+    """ A Slack message waiting to be sent, written in the same transaction as the change it announces. """
+    __tablename__ = 'outbox_messages'
+
+    id = Column(Integer, primary_key=True)
+    idempotency_key = Column(String, nullable=False)  # The same message is never queued twice
+    channel = Column(String, nullable=False)
+    text = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='pending')  # pending, sending, sent or dead
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=False), nullable=False, default=datetime.utcnow)
+    claimed_by = Column(String, nullable=True)  # Which drain is sending it, see src/outbox.py
+    claimed_at = Column(DateTime(timezone=False), nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=False), nullable=False, default=datetime.utcnow)
+    sent_at = Column(DateTime(timezone=False), nullable=True)
+
+    __table_args__ = (
+        Index('ix_outbox_messages_idempotency_key', idempotency_key, unique=True),
+        Index('ix_outbox_messages_status_next_attempt_at', status, next_attempt_at),
+    )
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ WAL lets the web process read while the scheduler writes, and the busy timeout queues writers up to wait. """
+    cursor = dbapi_connection.cursor()
+    # Only takes effect on new databases, src/retention.py converts existing ones.
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    if SQLITE_SYNCHRONOUS:
+        cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    cursor.close()
+
+
+def get_engine(url: str = DATABASE_URL) -> Engine:
+    """ Get the process-wide engine for a database, creating it (and the database) on first use. """
+    with _lock:
+        engine = _engines.get(url)
+        if engine is None:
+            if url.startswith('sqlite'):
+                engine = create_engine(url, poolclass=QueuePool, pool_size=DB_POOL_SIZE,
+                                       connect_args={'check_same_thread': False})
+                event.listen(engine, 'connect', _set_sqlite_pragmas)
+            else:
+                engine = create_engine(url, pool_size=DB_POOL_SIZE, pool_pre_ping=True)
+            instrument_engine(engine)
+            if not database_exists(engine.url):
+                create_database(engine.url)
+                Base.metadata.create_all(engine)
+                stamp(engine)
+            else:
+                upgrade(engine)
+            _engines[url] = engine
+        return engine
+
+
+def get_session(url: str = DATABASE_URL) -> sqlalchemy.orm.Session:
+    """
+    Get the thread-local session for a database. The returned registry proxies to a separate session per thread, so it
+    can be stored on long-lived objects shared by Flask request threads. Call remove_session when a unit of work (a
+    request or scheduled job) is done.
+    """
+    engine = get_engine(url)
+    with _lock:
+        if url not in _sessions:
+            _sessions[url] = scoped_session(sessionmaker(bind=engine))
+        return _sessions[url]
 
 
-def get_session() -> sqlalchemy.orm.Session:
-    engine = create_engine("sqlite:///db/meeting_surveyor.db")
-    if not database_exists(engine.url):
-        create_database(engine.url)
-        Base.metadata.create_all(engine)
-    return sessionmaker(bind=engine)()
+def remove_session(url: str = DATABASE_URL) -> None:
+    """ Close the current thread's session, returning its connection to the pool. """
+    if url in _sessions:
+        _sessions[url].remove()
 
 
 if __name__ == '__main__':
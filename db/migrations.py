@@ -0,0 +1,199 @@
+"""
+Schema migrations for databases created before a model change. New databases are built from the models with
+create_all and stamped at the latest version, existing ones are upgraded in place by get_engine on startup, or by
+running this module directly.
+
+Each migration is a function taking a connection, applied in the order they're declared here. The number of
+migrations applied is kept in the schema_migrations table. Migrations should be safe to re-run against a database
+that already has the change, since databases created from the models skip straight to the latest version.
+"""
+import logging
+import os
+from typing import Callable, List, Optional
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+MIGRATIONS: List[Callable[[Connection], None]] = []
+
+
+def migration(fn: Callable[[Connection], None]) -> Callable[[Connection], None]:
+    MIGRATIONS.append(fn)
+    return fn
+
+
+def _add_column(connection: Connection, table: str, column: str, ddl_type: str) -> None:
+    if column not in {c['name'] for c in inspect(connection).get_columns(table)}:
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl_type}'))
+
+
+@migration
+def add_sync_token_and_attendees(connection: Connection) -> None:
+    _add_column(connection, 'users', 'calendar_sync_token', 'VARCHAR')
+    _add_column(connection, 'events', 'attendees', 'JSON')
+
+
+@migration
+def add_hot_path_indexes(connection: Connection) -> None:
+    # Events used to be inserted once per attendee when several calendars synced the same meeting in one cycle, merge
+    # those into the oldest row before google_event_id becomes unique.
+    duplicates = connection.execute(text(
+        'SELECT google_event_id, MIN(id) FROM events GROUP BY google_event_id HAVING COUNT(*) > 1'
+    )).fetchall()
+    for google_event_id, keep_id in duplicates:
+        params = {'google_event_id': google_event_id, 'keep_id': keep_id}
+        duplicate_ids = 'SELECT id FROM events WHERE google_event_id = :google_event_id AND id != :keep_id'
+        connection.execute(text(f'UPDATE survey_responses SET event_id = :keep_id WHERE event_id IN ({duplicate_ids})'),
+                           params)
+        connection.execute(text(f'UPDATE users SET awaiting_response_on = :keep_id '
+                                f'WHERE awaiting_response_on IN ({duplicate_ids})'), params)
+        connection.execute(text(f'DELETE FROM events WHERE id IN ({duplicate_ids})'), params)
+
+    for statement in [
+        'CREATE INDEX IF NOT EXISTS ix_survey_responses_event_id_user_id ON survey_responses (event_id, user_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_events_google_event_id ON events (google_event_id)',
+        'CREATE INDEX IF NOT EXISTS ix_events_pending_questions '
+        'ON events (survey_questions_sent, should_send_survey, end_datetime)',
+        'CREATE INDEX IF NOT EXISTS ix_events_pending_results '
+        'ON events (survey_results_sent, survey_questions_sent, end_datetime)',
+    ]:
+        connection.execute(text(statement))
+
+
+def _create_table(connection: Connection, table_name: str) -> None:
+    """ Create a table (and its indexes) as it's currently declared in the models, if it doesn't exist yet. """
+    from db.database import Base  # db.database imports this module, so it can't be imported at the top.
+    Base.metadata.tables[table_name].create(connection, checkfirst=True)
+
+
+@migration
+def add_outbox(connection: Connection) -> None:
+    _create_table(connection, 'outbox_messages')
+
+
+@migration
+def add_survey_tallies(connection: Connection) -> None:
+    _create_table(connection, 'survey_tallies')
+    connection.execute(text('DELETE FROM survey_tallies'))
+    connection.execute(text(
+        'INSERT INTO survey_tallies (event_id, response, count) '
+        'SELECT event_id, response, COUNT(*) FROM survey_responses GROUP BY event_id, response'
+    ))
+
+
+@migration
+def add_slack_directory_sync(connection: Connection) -> None:
+    _add_column(connection, 'users', 'is_deleted', 'BOOLEAN NOT NULL DEFAULT 0')
+    _create_table(connection, 'sync_checkpoints')
+
+
+@migration
+def add_calendar_channels(connection: Connection) -> None:
+    _add_column(connection, 'users', 'calendar_changed_at', 'DATETIME')
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_users_calendar_changed_at ON users (calendar_changed_at)'))
+    _create_table(connection, 'calendar_channels')
+
+
+@migration
+def add_worker_leases(connection: Connection) -> None:
+    _create_table(connection, 'workers')
+    _create_table(connection, 'worker_leases')
+
+
+@migration
+def add_access_tokens(connection: Connection) -> None:
+    _add_column(connection, 'users', 'access_token', 'VARCHAR')
+    _add_column(connection, 'users', 'access_token_expires_at', 'DATETIME')
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_users_access_token_expires_at ON users (access_token_expires_at)'
+    ))
+
+
+@migration
+def add_event_archival(connection: Connection) -> None:
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_events_end_datetime ON events (end_datetime)'))
+    _create_table(connection, 'event_summaries')
+
+
+@migration
+def add_organizer_rollups(connection: Connection) -> None:
+    for table, column, ddl_type in [
+        ('events', 'is_cancelled', 'BOOLEAN NOT NULL DEFAULT 0'),
+        ('events', 'duration_minutes', 'INTEGER'),
+        ('events', 'cost', 'FLOAT'),
+        ('events', 'description_words', 'INTEGER'),
+        ('events', 'is_zoom', 'BOOLEAN'),
+        ('event_summaries', 'is_cancelled', 'BOOLEAN NOT NULL DEFAULT 0'),
+        ('event_summaries', 'duration_minutes', 'INTEGER'),
+        ('event_summaries', 'cost', 'FLOAT'),
+        ('event_summaries', 'description_words', 'INTEGER'),
+    ]:
+        _add_column(connection, table, column, ddl_type)
+    _create_table(connection, 'organizer_weeks')
+    _create_table(connection, 'organizer_week_responses')
+    from src.rollups import backfill_event_stats, rebuild_rollups  # Imports db.database, like _create_table.
+    backfill_event_stats(connection)
+    rebuild_rollups(connection)
+
+
+@migration
+def drop_duplicate_user_indexes(connection: Connection) -> None:
+    # email_address and slack_id have always had unique constraints, these indexes only doubled them up.
+    connection.execute(text('DROP INDEX IF EXISTS ix_users_email_address'))
+    connection.execute(text('DROP INDEX IF EXISTS ix_users_slack_id'))
+
+
+@migration
+def add_event_notifications(connection: Connection) -> None:
+    # Existing events have either been notified about already or were skipped, don't send them now.
+    if 'notification_sent' not in {c['name'] for c in inspect(connection).get_columns('events')}:
+        connection.execute(text('ALTER TABLE events ADD COLUMN notification_sent BOOLEAN NOT NULL DEFAULT 0'))
+        connection.execute(text('UPDATE events SET notification_sent = 1'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_events_pending_notifications ON events (notification_sent, start_datetime)'
+    ))
+
+
+def _ensure_version_table(connection: Connection) -> None:
+    connection.execute(text('CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER NOT NULL)'))
+
+
+def current_version(connection: Connection) -> int:
+    _ensure_version_table(connection)
+    version = connection.execute(text('SELECT MAX(version) FROM schema_migrations')).scalar()
+    return version or 0
+
+
+def _set_version(connection: Connection, version: int) -> None:
+    _ensure_version_table(connection)
+    connection.execute(text('DELETE FROM schema_migrations'))
+    connection.execute(text('INSERT INTO schema_migrations (version) VALUES (:version)'), {'version': version})
+
+
+def stamp(engine: Engine, version: Optional[int] = None) -> None:
+    """ Mark a database as being at a version (default latest) without running anything, for new databases. """
+    with engine.begin() as connection:
+        _set_version(connection, len(MIGRATIONS) if version is None else version)
+
+
+def upgrade(engine: Engine) -> int:
+    """
+    Apply any migrations the database hasn't had yet, each in its own transaction.
+    :return: The number of migrations applied
+    """
+    with engine.begin() as connection:
+        version = current_version(connection)
+    for number, fn in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Applying migration {number}: {fn.__name__}")
+        with engine.begin() as connection:
+            fn(connection)
+            _set_version(connection, number)
+    return len(MIGRATIONS) - version
+
+
+if __name__ == '__main__':
+    if os.getcwd().endswith(os.sep + 'db'):
+        os.chdir('..')
+    logging.basicConfig(level=logging.INFO)
+    from db.database import get_engine  # get_engine upgrades the database it opens.
+    get_engine()
@@ -1,16 +1,35 @@
 from authlib.integrations.flask_client import OAuth
-from flask import Flask, Response, url_for, session
+from flask import Flask, Response, url_for, session, request, g, abort
 from slackeventsapi import SlackEventAdapter
 import os
 from src.meeting_surveyor import MeetingSurveyor, SURVEY_RESPONSES
-
+from src.slack_event_queue import SlackEventQueue
+from src.calendar_watch import CalendarWatcher
+from src.google_scheduler import google_scheduler
+from src.rollups import org_report, organizer_report, report_range
+from src.user_directory import user_directory
+from src import metrics
+from src.metrics import track_job
+from db.database import get_session, remove_session
+
+import hmac
 import json
+import queue
+import time
+from typing import Optional
 
 
 app = Flask(__name__)
 app.secret_key = os.getenv("APP_SECRET_KEY")
 SLACK_SIGNING_SECRET = os.environ["SLACK_SIGNING_SECRET"]
+# Shared secret for the /reports endpoints, sent as "Authorization: Bearer <token>". Without one they're turned off.
+REPORTS_TOKEN = os.getenv("REPORTS_TOKEN")
+# The same for /metrics and the /stats endpoints, Prometheus can send it with its scrape config's authorization.
+STATS_TOKEN = os.getenv("STATS_TOKEN")
 meeting_surveyor = MeetingSurveyor()
+meeting_surveyor.outbox.start()
+calendar_watcher = CalendarWatcher()
+calendar_watcher.start()
 
 # oAuth Setup
 oauth = OAuth(app)
@@ -30,6 +49,11 @@ scope = [
     "https://www.googleapis.com/auth/calendar.readonly"
 ]
 
+
+@app.teardown_appcontext
+def cleanup_db_session(exception=None):
+    remove_session()
+
 @app.route("/slack/events")
 def event_hook(request):
     json_dict = json.loads(request.body.decode("utf-8"))
@@ -51,9 +75,26 @@ slack_events_adapter = SlackEventAdapter(
 
 @slack_events_adapter.on("message")
 def handle_message(event_data):
+    """ Ack straight away, Slack redelivers anything that takes more than 3 seconds. """
     if not event_data.get('event', {}).get('user'):
         return Response(status=200)
 
+    try:
+        slack_event_queue.submit(event_data, retry_num=request.headers.get('X-Slack-Retry-Num'))
+    except queue.Full:
+        abort(503)  # Slack will retry it later
+    return Response(status=200)
+
+
+def process_message(event_data):
+    try:
+        with track_job('handle_message'):
+            _process_message(event_data)
+    finally:
+        remove_session()
+
+
+def _process_message(event_data):
     text = event_data['event']['text'].lower().strip()
 
     fixed_user_commands = {
@@ -73,6 +114,89 @@ def handle_message(event_data):
     else:
         meeting_surveyor.send_error(slack_id, cleaned_text)
 
+
+slack_event_queue = SlackEventQueue(process_message)
+
+
+@app.before_request
+def start_ack_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_ack_time(response):
+    if request.path == '/slack/events':
+        slack_event_queue.record_ack(time.perf_counter() - g.request_started)
+    return response
+
+
+def _check_token(token: Optional[str]):
+    """ Abort unless the request has the token as its bearer token, or with a 404 if the token isn't set. """
+    if not token:
+        abort(404)
+    expected = f'Bearer {token}'.encode()
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected):
+        abort(401)
+
+
+@app.route('/slack/stats')
+def slack_stats():
+    _check_token(STATS_TOKEN)
+    return slack_event_queue.stats()
+
+
+@app.route('/stats/user-cache')
+def user_cache_stats():
+    _check_token(STATS_TOKEN)
+    return user_directory.stats()
+
+
+@app.route('/stats/google')
+def google_quota_stats():
+    _check_token(STATS_TOKEN)
+    return google_scheduler.stats()
+
+
+def _report_range():
+    try:
+        return report_range(request.args.get('since'), request.args.get('until'))
+    except ValueError:
+        abort(400)
+
+
+@app.route('/reports/organizers')
+def organizers_report():
+    """ Meeting cost and effectiveness org-wide and for the costliest organizers, ?since=&until= as ISO dates. """
+    _check_token(REPORTS_TOKEN)
+    return org_report(get_session(), *_report_range())
+
+
+@app.route('/reports/organizers/<organizer_email>')
+def organizer_digest(organizer_email):
+    """ An organizer's meeting cost and effectiveness week by week, ?since=&until= as ISO dates. """
+    _check_token(REPORTS_TOKEN)
+    return organizer_report(get_session(), organizer_email, *_report_range())
+
+
+metrics.GaugeFunction('meeting_surveyor_slack_event_queue_depth', 'Slack events waiting to be processed',
+                      lambda: slack_event_queue.stats()['queue_depth'])
+metrics.GaugeFunction('meeting_surveyor_user_cache_hits', 'User directory cache hits',
+                      lambda: user_directory.stats()['hits'])
+metrics.GaugeFunction('meeting_surveyor_user_cache_misses', 'User directory cache misses',
+                      lambda: user_directory.stats()['misses'])
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    _check_token(STATS_TOKEN)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/google/calendar/notifications', methods=['POST'])
+def calendar_notification():
+    """ Google pings this when a watched calendar changes, the scheduler syncs that user on its next refresh. """
+    if not calendar_watcher.handle_notification(request.headers):
+        return Response(status=404)
     return Response(status=200)
 
 
@@ -1,52 +1,163 @@
-import schedule
-import time
+import functools
 from src.meeting_surveyor import MeetingSurveyor
 from src.calendar_api_wrapper import CalendarAPIWrapper
+from src.outbox import get_outbox, prune_outbox
+from src.calendar_watch import users_to_sync, mark_synced
+from src.deadline_scheduler import DeadlineScheduler
+from src.helpers import chunked, MAX_SQL_VARIABLES
+from src import metrics
+from src.metrics import track_job
+from src.worker_leases import ShardLeases
+from src.retention import Archiver
+from db.database import remove_session
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Dict
 
-global stale_refresh
-stale_refresh = True
+# How often each worker looks for survey steps coming due in its shards.
+STEP_POLL_INTERVAL = timedelta(seconds=int(os.getenv('SURVEY_STEP_POLL_SECONDS', 60)))
 
 
+def scheduled_job(job):
+    """
+    Record the job's duration and DB queries under its name, and close its DB session when it finishes so the next
+    run starts from a clean identity map.
+    """
+    @functools.wraps(job)
+    def wrapper(*args, **kwargs):
+        try:
+            with track_job(job.__name__):
+                return job(*args, **kwargs)
+        finally:
+            remove_session()
+    return wrapper
+
+
+@scheduled_job
 def refresh_slack_users():
+    if not leases.is_leader():
+        return  # The directory is shared, one worker syncs it.
     print("Refreshing Slack Users!")
     ms = MeetingSurveyor()
     ms.populate_slack_users()
 
 
-def refresh_events():
-    global stale_refresh
-    print("Refreshing upcoming events!")
+@scheduled_job
+def refresh_events(everyone: bool = False):
+    """
+    Sync the calendars which Google has told us changed, and those of users we aren't getting notifications for. Every
+    connected calendar is synced at startup and every CALENDAR_SWEEP_HOURS in case a notification was missed, which
+    also relists the upcoming events that have come into the sync window, see CalendarAPIWrapper.populate_events.
+    """
+    shards = leases.owned()
+    if not shards:
+        return
     cal = CalendarAPIWrapper()
-    new_events = cal.populate_events()
+    started_at = datetime.utcnow()
+    user_ids = users_to_sync(cal.session, shards, everyone=everyone)
+    if not user_ids:
+        return
+    print("Refreshing upcoming events!")
+    cal.populate_events(incremental=True, user_ids=user_ids, relist=everyone)
+    mark_synced(cal.session, cal.synced_user_ids, started_at)
+    cal.session.commit()
     ms = MeetingSurveyor()
+    for google_event_ids in chunked(cal.changed_google_ids, MAX_SQL_VARIABLES):
+        schedule_deadlines(ms.get_deadlines(google_event_ids=google_event_ids))
 
-    if not stale_refresh:
-        for event in new_events:
-            if event.organizer_id:
-                ms.send_event_notification(event)
-    stale_refresh = False
 
+@scheduled_job
+def refresh_access_tokens():
+    """ Renew the Google access tokens in our shards which are about to expire, before a sync needs them. """
+    shards = leases.owned()
+    if shards:
+        counts = CalendarAPIWrapper().refresh_expiring_tokens(shards)
+        if any(counts.values()):
+            print(f"{counts['refreshed']} access tokens refreshed, {counts['failed']} failed!")
 
-def send_survey_questions():
-    # send any pending questions
-    print("sending survey questions!")
-    ms = MeetingSurveyor()
-    ms.send_pending_questions()
 
-def send_survey_result():
-    # send any pending survey results.
-    print("sending pending results!")
+@scheduled_job
+def archive_old_events():
+    """ Move events past retention and their responses to the archive, and prune the outbox, on one worker. """
+    if leases.is_leader():
+        Archiver().run()
+        print(f"{prune_outbox()} old outbox messages pruned!")
+
+
+@scheduled_job
+def send_event_notifications():
+    """ Tell organizers in our shards about their meetings starting within a day, see NOTIFICATION_LEAD. """
+    shards = leases.owned()
+    if shards:
+        MeetingSurveyor().send_pending_notifications(shards)
+
+
+@scheduled_job
+def run_survey_step(event_id: int, scheduled_for: datetime):
+    """ Send whatever is due for an event, then schedule its next step. """
+    if scheduled_steps.get(event_id) != scheduled_for:
+        return  # Rescheduled since
+    del scheduled_steps[event_id]
+    if not leases.owns(event_id):
+        return  # Its shard moved to another worker, which picks it up from the DB.
+
     ms = MeetingSurveyor()
-    ms.send_pending_results()
+    last_step = None
+    while True:
+        deadlines = ms.get_deadlines(event_ids=[event_id])
+        if not deadlines:
+            return  # All sent, or the event is no longer being surveyed.
+        due_at, step, _ = deadlines[0]
+        if due_at > datetime.utcnow():
+            # Not due yet, either it's the next step or the meeting was moved later.
+            schedule_deadlines(deadlines)
+            return
+        if step == last_step:
+            print(f"Couldn't send survey {step} for event {event_id}, leaving it for the next poll.")
+            return
+        print(f"sending survey {step} for event {event_id}!")
+        if step == 'question':
+            ms.send_survey_question(event_id)
+        else:
+            ms.send_survey_results(event_id)
+        last_step = step
+
+
+@scheduled_job
+def poll_survey_steps():
+    """
+    Schedule the survey steps coming due in our shards. This picks up events changed by other workers and shards taken
+    over from a worker which died, our own changes are scheduled as soon as they're synced.
+    """
+    shards = leases.owned()
+    if shards:
+        due_before = datetime.utcnow() + 2 * STEP_POLL_INTERVAL
+        schedule_deadlines(MeetingSurveyor().get_deadlines(shards=shards, due_before=due_before))
+
+
+def schedule_deadlines(deadlines):
+    """ Schedule the steps of events in our shards, unless they're already scheduled for that time. """
+    for due_at, _, event_id in deadlines:
+        if leases.owns(event_id) and scheduled_steps.get(event_id) != due_at:
+            scheduled_steps[event_id] = due_at
+            scheduler.add(due_at, run_survey_step, event_id, due_at)
+
 
-refresh_slack_users()
-schedule.every().hour.do(refresh_slack_users)
-schedule.every(30).seconds.do(refresh_events)
-schedule.every(30).seconds.do(send_survey_questions)
-schedule.every(30).seconds.do(send_survey_result)
+# Only touched from the scheduler's thread.
+scheduled_steps: Dict[int, datetime] = {}  # Event id -> when its next survey step is scheduled
+scheduler = DeadlineScheduler()
+leases = ShardLeases(on_acquired=lambda shards: scheduler.add(datetime.utcnow(), poll_survey_steps))
 
-while True:
-    schedule.run_pending()
-    time.sleep(10)
\ No newline at end of file
+metrics.serve(int(os.getenv('METRICS_PORT', 9100)))
+metrics.GaugeFunction('meeting_surveyor_worker_shards', 'Shards owned by this worker', lambda: len(leases.owned()))
+get_outbox().start()
+leases.start()
+scheduler.every(STEP_POLL_INTERVAL, poll_survey_steps)
+scheduler.every(STEP_POLL_INTERVAL, send_event_notifications)
+scheduler.every(timedelta(minutes=1), refresh_access_tokens)
+scheduler.every(timedelta(hours=1), refresh_slack_users)
+scheduler.every(timedelta(days=1), archive_old_events)
+# The sweep goes first so the startup sync covers everyone.
+scheduler.every(timedelta(hours=int(os.getenv('CALENDAR_SWEEP_HOURS', 6))), refresh_events, True)
+scheduler.every(timedelta(seconds=30), refresh_events)
+scheduler.run_forever()
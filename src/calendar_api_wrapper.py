@@ -1,13 +1,122 @@
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Iterable, Iterator, Union, Optional, Tuple
 from db.database import get_session, Event, User
 from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache
 import os
-from googleapiclient.discovery import build
+import threading
+import time
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
+from sqlalchemy.exc import IntegrityError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 import pytz
 import logging
-from src.helpers import get_user
+from src.helpers import get_user, chunked, MAX_SQL_VARIABLES
+from src.user_directory import user_directory
+from src.google_scheduler import google_scheduler, BACKGROUND, INTERACTIVE
+from src.token_store import token_store
+from src.fetch_planner import fetch_planner
+from src.rollups import description_stats, meeting_stats, RollupBatch, ROLLUP_COLUMNS
+
+# Max number of users whose calendars are fetched from Google at the same time.
+SYNC_CONCURRENCY = int(os.getenv('CALENDAR_SYNC_CONCURRENCY', 8))
+# Max number of users whose credentials are kept alive between calls.
+CREDENTIALS_CACHE_SIZE = int(os.getenv('GOOGLE_CREDENTIALS_CACHE_SIZE', 1000))
+# Cached credentials are dropped and refreshed this long before Google says they expire.
+CREDENTIALS_EXPIRY_MARGIN = timedelta(minutes=5)
+# Max number of events whose Google details are cached, and how long cached details are used without asking Google
+# whether they changed. With the default of 0 every lookup is revalidated, which is free when nothing changed.
+EVENT_DETAILS_CACHE_SIZE = int(os.getenv('EVENT_DETAILS_CACHE_SIZE', 5000))
+EVENT_DETAILS_FRESH_SECONDS = float(os.getenv('EVENT_DETAILS_FRESH_SECONDS', 0))
+GOOGLE_TOKEN_URI = 'https://oauth2.googleapis.com/token'
+# Access tokens expiring within this window are refreshed ahead of time by refresh_expiring_tokens, at most
+# TOKEN_REFRESH_BATCH per run.
+TOKEN_PREREFRESH_WINDOW = timedelta(minutes=15)
+TOKEN_REFRESH_BATCH = int(os.getenv('TOKEN_REFRESH_BATCH', 200))
+# Events per events.list page, Google's max is 2500.
+CALENDAR_PAGE_SIZE = int(os.getenv('CALENDAR_PAGE_SIZE', 2500))
+# How far ahead a calendar's first sync, or a full sync after Google invalidates its token, lists events. Without a
+# bound that's every future instance of every recurring meeting.
+SYNC_WINDOW_DAYS = int(os.getenv('CALENDAR_SYNC_DAYS', 7))
+# Only the parts of each event populate_events uses, conferenceData is only checked for being there.
+EVENT_FIELDS = 'id,status,summary,description,created,start/dateTime,end/dateTime,organizer/email,' \
+               'attendees(email,responseStatus),conferenceData/conferenceId'
+EVENT_LIST_FIELDS = f'nextPageToken,nextSyncToken,items({EVENT_FIELDS})'
+
+
+@lru_cache(maxsize=None)
+def _calendar_discovery_document() -> str:
+    """ The Calendar API discovery document, read once per process instead of on every service build. """
+    return get_static_doc('calendar', 'v3')
+
+
+class CredentialsCache(object):
+    """
+    Thread-safe LRU cache of live credentials per user, so we only go back to Google's token endpoint when a user's
+    access token is close to expiring.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._credentials = OrderedDict()  # User id -> (refresh token, credentials)
+        self._lock = threading.Lock()
+
+    def get(self, user: User) -> Optional[Credentials]:
+        with self._lock:
+            entry = self._credentials.get(user.id)
+            if not entry:
+                return None
+            refresh_token, creds = entry
+            # A new refresh token means the user re-authorized, so whatever we have is stale.
+            if refresh_token != user.refresh_token or not creds.expiry \
+                    or creds.expiry - CREDENTIALS_EXPIRY_MARGIN <= datetime.utcnow():
+                del self._credentials[user.id]
+                return None
+            self._credentials.move_to_end(user.id)
+            return creds
+
+    def put(self, user: User, creds: Credentials) -> None:
+        with self._lock:
+            self._credentials[user.id] = (user.refresh_token, creds)
+            self._credentials.move_to_end(user.id)
+            while len(self._credentials) > self.max_size:
+                self._credentials.popitem(last=False)
+
+
+class EventDetailsCache(object):
+    """
+    Thread-safe LRU cache of event details from Google by google_event_id, with their ETag so they can be revalidated
+    with If-None-Match instead of downloaded again.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._events = OrderedDict()  # Google event id -> (time.monotonic() fetched or revalidated at, etag, details)
+        self._lock = threading.Lock()
+
+    def get(self, google_event_id: str) -> Optional[Tuple[float, str, dict]]:
+        with self._lock:
+            entry = self._events.get(google_event_id)
+            if entry:
+                self._events.move_to_end(google_event_id)
+            return entry
+
+    def put(self, google_event_id: str, etag: str, details: dict) -> None:
+        with self._lock:
+            self._events[google_event_id] = (time.monotonic(), etag, details)
+            self._events.move_to_end(google_event_id)
+            while len(self._events) > self.max_size:
+                self._events.popitem(last=False)
+
+
+# Shared by every CalendarAPIWrapper in the process.
+credentials_cache = CredentialsCache(CREDENTIALS_CACHE_SIZE)
+event_details_cache = EventDetailsCache(EVENT_DETAILS_CACHE_SIZE)
 
 
 class CalendarAPIWrapper(object):
@@ -18,18 +127,81 @@ class CalendarAPIWrapper(object):
     def __init__(self):
         self.session = get_session()
         self.scope = ['https://www.googleapis.com/auth/calendar.readonly']
+        # Inserted/updated/unchanged row counts from the last populate_events.
+        self.ingest_counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        # Google ids of the events inserted or updated by the last populate_events.
+        self.changed_google_ids: List[str] = []
+        # Users whose calendars were fetched without error by the last populate_events.
+        self.synced_user_ids: List[int] = []
+        # Events processed, and skipped as duplicate or unchanged copies, by the last populate_events.
+        self.dedup_counts = {'processed': 0, 'duplicate': 0, 'unchanged': 0}
 
-    def get_service(self, user: User):
-        tokens = {
-            'client_id': os.environ['GOOGLE_CLIENT_ID'],
-            'client_secret':  os.environ['GOOGLE_CLIENT_SECRET'],
-            'refresh_token': user.refresh_token
-        }
-        creds = Credentials.from_authorized_user_info(tokens, self.scope)
-        if creds and creds.expired or not creds.valid():
-            creds.refresh(Request())
-        service = build('calendar', 'v3', credentials=creds)
-        return service
+    def get_service(self, user: User, priority: int = BACKGROUND):
+        """
+        Get a Calendar service for the user, reusing cached credentials while their access token is still good, then
+        a token stored by another process, and only then going to Google's token endpoint.
+        :param priority: Of the token refresh, if one is needed
+        """
+        creds = credentials_cache.get(user)
+        if not creds:
+            stored = token_store.load(user.id, user.refresh_token)
+            creds = self._credentials(user.refresh_token, *(stored or ()))
+            if not creds.valid:
+                self._refresh_credentials(user, creds, priority)
+            credentials_cache.put(user, creds)
+
+        # httplib2.Http isn't thread-safe, so each request gets its own rather than sharing the service's.
+        def build_request(http, *args, **kwargs) -> HttpRequest:
+            return HttpRequest(AuthorizedHttp(creds, http=httplib2.Http()), *args, **kwargs)
+
+        return build_from_document(_calendar_discovery_document(), http=AuthorizedHttp(creds, http=httplib2.Http()),
+                                   requestBuilder=build_request)
+
+    def _credentials(self, refresh_token: str, access_token: Optional[str] = None,
+                     expiry: Optional[datetime] = None) -> Credentials:
+        return Credentials(
+            token=access_token,
+            expiry=expiry,
+            refresh_token=refresh_token,
+            token_uri=GOOGLE_TOKEN_URI,
+            client_id=os.environ['GOOGLE_CLIENT_ID'],
+            client_secret=os.environ['GOOGLE_CLIENT_SECRET'],
+            scopes=self.scope,
+        )
+
+    @staticmethod
+    def _refresh_credentials(user: User, creds: Credentials, priority: int = BACKGROUND) -> None:
+        google_scheduler.call(lambda: creds.refresh(Request()), user.id, 'oauth.token', priority)
+        token_store.save(user.id, user.refresh_token, creds.token, creds.expiry)
+
+    def refresh_expiring_tokens(self, shards: Optional[Iterable[int]] = None,
+                                window: timedelta = TOKEN_PREREFRESH_WINDOW, batch_size: int = TOKEN_REFRESH_BATCH,
+                                max_workers: int = SYNC_CONCURRENCY) -> Dict[str, int]:
+        """
+        Refresh a batch of the access tokens which are missing or expire within window, soonest first, storing and
+        caching them so syncs find a valid token without waiting on Google.
+        :param shards: Only users in these worker shards
+        :return: Counts of tokens refreshed and failed
+        """
+        users = token_store.due_for_refresh(self.session, window, batch_size, shards)
+
+        def refresh(user) -> None:
+            creds = self._credentials(user.refresh_token)
+            self._refresh_credentials(user, creds)
+            credentials_cache.put(user, creds)
+
+        counts = {'refreshed': 0, 'failed': 0}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(refresh, user): user for user in users}
+            for future, user in futures.items():
+                try:
+                    future.result()
+                    counts['refreshed'] += 1
+                except Exception as e:
+                    counts['failed'] += 1
+                    token_store.record_failure(user.id, user.refresh_token)
+                    logging.warning(f"Failed to refresh the access token of user {user.id}: {e}")
+        return counts
 
     def get_event(self, event_id: str) -> Event:
         """
@@ -39,82 +211,339 @@ class CalendarAPIWrapper(object):
         """
         return self.session.query(Event).filter_by(id=event_id).one()
 
-    def get_event_google_details(self, event_id: str) -> dict:
+    def get_event_attendees(self, event: Event) -> List[Dict]:
+        """
+        Get the attendees of an event from the snapshot stored at sync time, only falling back to Google (and storing
+        the result) for events synced before attendees were stored.
+        :return: List of dicts with the attendee's email and responseStatus
+        """
+        if event.attendees is None:
+            event.attendees = self._attendee_snapshot(self.get_event_google_details(event.id))
+            self.session.commit()
+        return event.attendees
+
+    @staticmethod
+    def _attendee_snapshot(event: dict) -> List[Dict]:
+        return [{'email': a['email'].lower(), 'responseStatus': a.get('responseStatus')}
+                for a in event.get('attendees', [])]
+
+    def get_event_google_details(self, event_id: str, max_age: Optional[float] = None,
+                                 priority: int = INTERACTIVE) -> dict:
         """
-        Get extended event details from Google APIs
+        Get extended event details from Google APIs. Details fetched before are revalidated with their ETag, so an
+        unchanged event costs a 304 with no body. The result is shared with other callers, don't modify it.
         :param event_id:
+        :param max_age: Seconds for which cached details are used without checking with Google, defaults to
+            EVENT_DETAILS_FRESH_SECONDS
+        :param priority: Against the Google quota, lookups are interactive unless they're part of a sync
         :return: Dict of event attributes
         """
         event = self.get_event(event_id)
+        google_event_id = event.google_event_id
+        cached = event_details_cache.get(google_event_id)
+        max_age = EVENT_DETAILS_FRESH_SECONDS if max_age is None else max_age
+        if cached and time.monotonic() - cached[0] <= max_age:
+            return cached[2]
+
         user = get_user(self.session, event.source_user_id)
-        service = self.get_service(user)
-        event = service.events().get(calendarId='primary', eventId=event.google_event_id).execute()
-        return event
+        service = self.get_service(user, priority)
+        request = service.events().get(calendarId='primary', eventId=google_event_id)
+        if cached and cached[1]:
+            request.headers['If-None-Match'] = cached[1]
+        try:
+            details = google_scheduler.call(request.execute, user.id, 'events.get', priority)
+        except HttpError as e:
+            if e.resp.status == 304 and cached:
+                details = cached[2]
+            else:
+                raise
+        event_details_cache.put(google_event_id, details.get('etag'), details)
+        return details
 
-    def get_events_for_user(self, user: User, min_attendees=3, max_attendees=12, days_out: int = 1)\
-            -> List[Dict]:
-        """ Get list of upcoming events for a user """
+    def get_events_for_user(self, user: User, min_attendees=3, max_attendees=12, days_out: int = 1,
+                            parse_times: bool = True) -> Iterator[Dict]:
+        """
+        Stream the upcoming events we survey from a user's calendar, a page at a time. Only the fields we use are
+        requested, and each page is filtered before any of its times are parsed.
+        :param parse_times: Add the parsed startTime/endTime/createdTime, otherwise left to the caller
+        """
         now = datetime.utcnow().isoformat() + 'Z'
         one_day = (datetime.utcnow() + timedelta(days_out)).isoformat() + 'Z'
         service = self.get_service(user)
-        events = service.events().list(calendarId='primary', timeMin=now, timeMax=one_day, singleEvents=True,
-                                       orderBy='startTime').execute()
+        page_token = None
+        while True:
+            request = service.events().list(calendarId='primary', timeMin=now, timeMax=one_day, singleEvents=True,
+                                            pageToken=page_token, maxResults=CALENDAR_PAGE_SIZE,
+                                            fields=EVENT_LIST_FIELDS)
+            response = google_scheduler.call(request.execute, user.id, 'events.list')
+            events = self._filter_events(response.get('items', []), min_attendees, max_attendees)
+            yield from map(self._parse_times, events) if parse_times else events
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
 
-        def convert(event: dict) -> dict:
-            event['startTime'] = datetime.fromisoformat(event['start']['dateTime']).astimezone(pytz.utc)
-            event['endTime'] = datetime.fromisoformat(event['end']['dateTime']).astimezone(pytz.utc)
-            event['createdTime'] = datetime.strptime(event['created'], '%Y-%m-%dT%H:%M:%S.%fZ')
-            return event
+    def get_event_changes_for_user(self, user: User, min_attendees=3, max_attendees=12, parse_times: bool = True) \
+            -> Tuple[List[Dict], List[str], Optional[str]]:
+        """
+        Get the events which changed since the last sync for a user using their stored Google sync token, falling back
+        to a full sync of upcoming events if there is no token or Google has invalidated it (HTTP 410). Doesn't touch
+        the DB so it can be run from worker threads, the caller is responsible for storing the new sync token.
+        :param parse_times: Add the parsed startTime/endTime/createdTime, otherwise left to the caller
+        :return: Tuple of (added or changed events, google ids of cancelled events, next sync token)
+        """
+        events, cancelled_ids, sync_token = self._get_event_changes(user, user.calendar_sync_token, min_attendees,
+                                                                    max_attendees)
+        return [self._parse_times(e) for e in events] if parse_times else events, cancelled_ids, sync_token
 
-        events = [convert(e) for e in events['items'] if max_attendees >= len(e.get('attendees', [])) >= min_attendees
-                  and e['start'].get('dateTime') and e.get('organizer')]
+    def _get_event_changes(self, user: User, sync_token: Optional[str], min_attendees: int, max_attendees: int) \
+            -> Tuple[List[Dict], List[str], Optional[str]]:
+        service = self.get_service(user)
+        request_args = {'calendarId': 'primary', 'singleEvents': True, 'maxResults': CALENDAR_PAGE_SIZE,
+                        'fields': EVENT_LIST_FIELDS}
+        if sync_token:
+            request_args['syncToken'] = sync_token
+        else:
+            request_args['timeMin'] = datetime.utcnow().isoformat() + 'Z'
+            request_args['timeMax'] = (datetime.utcnow() + timedelta(SYNC_WINDOW_DAYS)).isoformat() + 'Z'
 
-        return events
+        events, cancelled_ids = [], []
+        page_token = None
+        while True:
+            try:
+                request = service.events().list(pageToken=page_token, **request_args)
+                response = google_scheduler.call(request.execute, user.id, 'events.list')
+            except HttpError as e:
+                if e.resp.status == 410 and 'syncToken' in request_args:
+                    logging.info(f"Sync token for user {user.id} is no longer valid, running a full sync.")
+                    return self._get_event_changes(user, None, min_attendees, max_attendees)
+                raise
+            items = response.get('items', [])
+            cancelled_ids.extend(e['id'] for e in items if e.get('status') == 'cancelled')
+            events.extend(self._filter_events((e for e in items if e.get('status') != 'cancelled'), min_attendees,
+                                              max_attendees))
+            # The sync token is only returned with the last page.
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+        return events, cancelled_ids, response.get('nextSyncToken')
 
-    def populate_events(self, days_out: int = 1) -> List[Event]:
-        """ Get the upcoming events for all users. """
-        users = self.session.query(User).filter(User.refresh_token).all()
-        new_events = []
-        for user in users:
-            events = self.get_events_for_user(user, days_out=days_out)
+    @staticmethod
+    def _filter_events(items: Iterable[Dict], min_attendees: int, max_attendees: int) -> Iterator[Dict]:
+        """ Filter raw Google events down to the ones we survey, using only checks that don't need parsing. """
+        for event in items:
+            if not max_attendees >= len(event.get('attendees', ())) >= min_attendees:
+                continue
+            if not event.get('start', {}).get('dateTime') or not event.get('organizer'):
+                continue
+            # We only care about Zoom meetings
+            if not event.get('conferenceData') and 'Zoom' not in event.get('description', ''):
+                continue
+            yield event
+
+    @staticmethod
+    def _parse_times(event: dict) -> dict:
+        """ Add the event's start/end/created times as datetimes. """
+        event['startTime'] = datetime.fromisoformat(event['start']['dateTime']).astimezone(pytz.utc)
+        event['endTime'] = datetime.fromisoformat(event['end']['dateTime']).astimezone(pytz.utc)
+        event['createdTime'] = datetime.strptime(event['created'], '%Y-%m-%dT%H:%M:%S.%fZ')
+        return event
+
+    def populate_events(self, days_out: int = 1, incremental: bool = False, max_workers: int = SYNC_CONCURRENCY,
+                        user_ids: Optional[List[int]] = None, relist: bool = False) -> List[Event]:
+        """
+        Get the upcoming events for all users. Calendars are fetched from Google concurrently, a failure for one user
+        is logged and skipped, and the results are written to the DB in a single transaction. Copies of a meeting which
+        another calendar already supplied, or which haven't changed since they were last ingested, are skipped before
+        they're parsed, see src/fetch_planner.py.
+        :param days_out: How far ahead to look for events on a full sync.
+        :param incremental: Only pull events changed since each user's last sync, using their Google sync token.
+            Changes aren't limited to days_out, but a user's first sync only lists the next SYNC_WINDOW_DAYS.
+        :param relist: On an incremental sync, also list the next SYNC_WINDOW_DAYS of users who have a sync token, to
+            pick up events which have come into the window without changing since the first sync.
+        :param max_workers: Max number of users fetched from Google at the same time.
+        :param user_ids: Only sync these users, rather than everyone with a calendar connected.
+        """
+        query = self.session.query(User).filter(User.refresh_token)
+        if user_ids is None:
+            users = query.all()
+        else:
+            users = [u for chunk in chunked(user_ids, MAX_SQL_VARIABLES) for u in query.filter(User.id.in_(chunk))]
+
+        def fetch(user: User) -> Tuple[List[Dict], List[str], Optional[str]]:
+            if incremental:
+                events, cancelled_ids, sync_token = self.get_event_changes_for_user(user, parse_times=False)
+                if relist and user.calendar_sync_token:
+                    seen_ids = {e['id'] for e in events}.union(cancelled_ids)
+                    events += [e for e in self.get_events_for_user(user, days_out=SYNC_WINDOW_DAYS, parse_times=False)
+                               if e['id'] not in seen_ids]
+                return events, cancelled_ids, sync_token
+            return list(self.get_events_for_user(user, days_out=days_out, parse_times=False)), [], \
+                user.calendar_sync_token
+
+        results = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch, user): user for user in users}
+            for future, user in futures.items():
+                try:
+                    results.append((user, *future.result()))
+                except Exception:
+                    logging.exception(f"Failed to fetch events for user {user.id}, skipping.")
+
+        self.synced_user_ids = [user.id for user, _, _, _ in results]
+        plan = fetch_planner.plan()
+        planned = [(user, [self._parse_times(e) for e in events if plan.should_process(e, user.email_address)])
+                   for user, events, _, _ in results]
+        cancellations = [(user, google_id) for user, _, ids, _ in results for google_id in ids]
+        for attempt in range(2):
+            try:
+                for user, _, _, sync_token in results:
+                    user.calendar_sync_token = sync_token
+                new_events = self._ingest_events(planned)
+                self._cancel_events(cancellations)
+                self.session.commit()
+                break
+            except IntegrityError:
+                # Another worker inserted one of the same meetings first, on the retry it's updated instead.
+                self.session.rollback()
+                if attempt:
+                    raise
+        fetch_planner.record(self._ingested_fingerprints(planned))
+        fetch_planner.forget(google_id for _, google_id in cancellations)
+
+        self.dedup_counts = plan.counts
+        logging.info(f"{self.ingest_counts['inserted']} events added, {self.ingest_counts['updated']} updated, "
+                     f"{self.ingest_counts['unchanged']} unchanged, {plan.counts['duplicate']} duplicate and "
+                     f"{plan.counts['unchanged']} known copies skipped ({plan.dedup_ratio:.0%} deduplicated)!")
+        return new_events
+
+    @staticmethod
+    def _ingested_fingerprints(planned: List[Tuple[User, List[Dict]]]) -> List[Tuple[str, int, bool]]:
+        """ (google id, fingerprint, from the organizer) of the copy of each event that was ingested. """
+        ingested = {}
+        for user, events in planned:
             for event in events:
-                organizer_email = event['organizer']['email'].lower()
-                organizer = self.session.query(User).filter_by(email_address=organizer_email).one_or_none()
+                from_organizer = user.email_address == event['organizer']['email'].lower()
+                if event['id'] not in ingested or from_organizer:
+                    ingested[event['id']] = (event['id'], event['fingerprint'], from_organizer)
+        return list(ingested.values())
 
-                # We only care about Zoom meetings
-                if not event.get('conferenceData') and 'Zoom' not in event.get('description', ''):
-                    continue
+    def _ingest_events(self, results: List[Tuple[User, List[Dict]]]) -> List[Event]:
+        """
+        Upsert fetched events in bulk. Organizers and existing events are looked up with one IN query per chunk rather
+        than per event, and only rows which actually changed are updated, with the organizers' weekly rollups.
+        Doesn't commit.
+        :param results: (source user, events fetched from their calendar) pairs
+        :return: The newly inserted events
+        """
+        self.changed_google_ids = []
+        # The same meeting shows up in every attendee's calendar, keep one copy and always prefer the organizer's.
+        fetched = {}
+        for user, events in results:
+            for event in events:
+                if event['id'] not in fetched or user.email_address == event['organizer']['email'].lower():
+                    fetched[event['id']] = (user, event)
+
+        organizer_emails = {event['organizer']['email'].lower() for _, event in fetched.values()}
+        organizers = user_directory.get_many_by_email(self.session, organizer_emails)
+        organizer_ids = {u.email_address: u.id for u in organizers}
 
-                existing_event = self.session.query(Event).filter_by(google_event_id=event['id']).one_or_none()
-                if existing_event:
-                    existing_event.start_datetime = event['startTime']
-                    existing_event.end_datetime = event['endTime']
-                    existing_event.organizer_email = organizer_email
-                    # Always prefer having the organizer for our source
-                    if existing_event.organizer_id == user.id:
-                        existing_event.source_user_id = user.id
-                    self.session.commit()
-                else:
-                    new_events.append(
-                        Event(
-                            google_event_id=event['id'],
-                            name=event['summary'],
-                            organizer_id=organizer.id if organizer else None,
-                            organizer_email=organizer_email,
-                            start_datetime=event['startTime'],
-                            end_datetime=event['endTime'],
-                            created_at_datetime=event['createdTime'],
-                            description=event.get('description'),
-                            survey_questions_sent=False,
-                            source_user_id=user.id,
-                            num_attendees=len(event['attendees'])
-                        )
+        columns = [Event.id, Event.google_event_id, Event.organizer_id, Event.end_datetime, Event.num_attendees,
+                   Event.attendees, Event.source_user_id, *[getattr(Event, column) for column in ROLLUP_COLUMNS]]
+        existing = {}
+        for chunk in chunked(fetched, MAX_SQL_VARIABLES):
+            existing.update(
+                (row.google_event_id, row)
+                for row in self.session.query(*columns).filter(Event.google_event_id.in_(chunk))
+            )
+
+        new_events = []
+        updates = []
+        rollups = RollupBatch()
+        for google_id, (user, event) in fetched.items():
+            organizer_email = event['organizer']['email'].lower()
+            values = {
+                'organizer_email': organizer_email,
+                'start_datetime': event['startTime'].replace(tzinfo=None),
+                'end_datetime': event['endTime'].replace(tzinfo=None),
+                'num_attendees': len(event['attendees']),
+                'attendees': self._attendee_snapshot(event),
+            }
+            values.update(meeting_stats(values['start_datetime'], values['end_datetime'], values['num_attendees']))
+            row = existing.get(google_id)
+            if row:
+                # Always prefer having the organizer for our source
+                if row.organizer_id == user.id:
+                    values['source_user_id'] = user.id
+                changed = {k: v for k, v in values.items() if getattr(row, k) != v}
+                if row.is_cancelled:
+                    # A live copy of a meeting we had as cancelled, e.g. it was restored in Google.
+                    changed.update(is_cancelled=False, should_send_survey=True)
+                if changed:
+                    updates.append({'id': row.id, **changed})
+                    rollups.update_event(row.id, row, changed)
+                    self.changed_google_ids.append(google_id)
+            else:
+                new_events.append(
+                    Event(
+                        google_event_id=google_id,
+                        name=event['summary'],
+                        organizer_id=organizer_ids.get(organizer_email),
+                        created_at_datetime=event['createdTime'],
+                        description=event.get('description'),
+                        survey_questions_sent=False,
+                        source_user_id=user.id,
+                        is_cancelled=False,
+                        **description_stats(event.get('description'), bool(event.get('conferenceData'))),
+                        **values
                     )
+                )
+                rollups.add_event(new_events[-1])
+
+        self.changed_google_ids.extend(e.google_event_id for e in new_events)
         self.session.bulk_save_objects(new_events)
-        self.session.commit()
-        logging.info(f"{len(new_events)} events added!")
+        self.session.bulk_update_mappings(Event, updates)
+        rollups.apply(self.session)
+        self.ingest_counts = {
+            'inserted': len(new_events),
+            'updated': len(updates),
+            'unchanged': len(existing) - len(updates),
+        }
         return new_events
 
+    def _cancel_events(self, cancellations: List[Tuple[User, str]]) -> None:
+        """
+        Stop surveying events which were cancelled in Google, and take them out of the rollups. A meeting also shows
+        as cancelled in an attendee's calendar when they were removed from it or deleted their copy, so only the
+        organizer's or our source user's copy cancels it, other copies just stop that attendee being surveyed.
+        Doesn't commit.
+        :param cancellations: (user, google event id) of the cancelled copies in each user's calendar
+        """
+        users_by_event: Dict[str, List[User]] = {}
+        for user, google_id in cancellations:
+            users_by_event.setdefault(google_id, []).append(user)
+
+        rollups = RollupBatch()
+        cancelled_ids, updates = [], []
+        columns = [Event.id, Event.google_event_id, Event.source_user_id, Event.attendees,
+                   *[getattr(Event, column) for column in ROLLUP_COLUMNS]]
+        for chunk in chunked(list(users_by_event), MAX_SQL_VARIABLES):
+            for row in self.session.query(*columns).filter(Event.google_event_id.in_(chunk)):
+                users = users_by_event[row.google_event_id]
+                if any(u.id == row.source_user_id or u.email_address == row.organizer_email for u in users):
+                    if not row.is_cancelled:
+                        rollups.add_event(row, -1)
+                        cancelled_ids.append(row.id)
+                    continue
+                removed = {u.email_address for u in users}
+                attendees = [a for a in row.attendees or [] if a['email'] not in removed]
+                if row.attendees is not None and len(attendees) != len(row.attendees):
+                    updates.append({'id': row.id, 'attendees': attendees})
+        for chunk in chunked(cancelled_ids, MAX_SQL_VARIABLES):
+            self.session.query(Event).filter(Event.id.in_(chunk)).update(
+                {Event.should_send_survey: False, Event.is_cancelled: True}, synchronize_session=False
+            )
+        self.session.bulk_update_mappings(Event, updates)
+        rollups.apply(self.session)
 
 if __name__ == '__main__':
     cal = CalendarAPIWrapper()
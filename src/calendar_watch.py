@@ -0,0 +1,212 @@
+"""
+Google Calendar push notifications. Every connected user's primary calendar is watched with an events.watch channel
+which pings CALENDAR_WEBHOOK_URL when anything in it changes. A ping only marks the user as changed, the scheduler's
+refresh_events then syncs just the changed users (and anyone without a live channel) using their sync token, so the
+cost of a sync follows the number of calendars which actually changed rather than the number of users.
+
+Notifications can be simulated locally against a running app, for a user who has a channel, with:
+
+    python3 -m src.calendar_watch simulate user@example.com --url http://localhost:3000/google/calendar/notifications
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Mapping, Optional
+from uuid import uuid4
+import argparse
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+import urllib.request
+
+from sqlalchemy import and_, or_
+from db.database import get_session, remove_session, CalendarChannel, User
+from src.calendar_api_wrapper import CalendarAPIWrapper
+from src.helpers import chunked, MAX_SQL_VARIABLES
+from src.google_scheduler import google_scheduler
+from src.metrics import track_job
+from src.worker_leases import in_shards
+
+# Where Google sends notifications, it has to be HTTPS on a domain verified for the project. Without one nobody is
+# watched and every connected calendar is polled as before.
+CALENDAR_WEBHOOK_URL = os.getenv('CALENDAR_WEBHOOK_URL') or \
+    (os.environ['HOST'] + '/google/calendar/notifications' if os.getenv('HOST') else None)
+# Google keeps calendar channels for at most a week, they can't be extended so a new one replaces each before it ends.
+CHANNEL_TTL = timedelta(days=7)
+CHANNEL_RENEW_MARGIN = timedelta(hours=12)
+# How often channels are created for newly connected users and replaced when close to expiring.
+CHANNEL_MAINTENANCE_SECONDS = float(os.getenv('CALENDAR_CHANNEL_MAINTENANCE_SECONDS', 3600))
+
+
+def users_to_sync(session, shards: Optional[Iterable[int]] = None, everyone: bool = False) -> List[int]:
+    """
+    Connected users whose calendars changed since their last sync, or who aren't watched by a live channel.
+    :param shards: Only users in these worker shards
+    :param everyone: All connected users, whether or not they changed
+    """
+    query = session.query(User.id).filter(User.refresh_token.isnot(None), User.is_deleted.is_(False))
+    if shards is not None:
+        query = query.filter(in_shards(User.id, shards))
+    if not everyone:
+        live = session.query(CalendarChannel.user_id).filter(CalendarChannel.expires_at > datetime.utcnow())
+        query = query.filter(or_(User.calendar_changed_at.isnot(None), User.id.notin_(live)))
+    return [row.id for row in query]
+
+
+def mark_synced(session, user_ids: List[int], started_at: datetime) -> None:
+    """ Clear the users' pending changes, except ones notified after the sync started. Doesn't commit. """
+    for chunk in chunked(user_ids, MAX_SQL_VARIABLES):
+        session.query(User).filter(User.id.in_(chunk), User.calendar_changed_at <= started_at).update(
+            {User.calendar_changed_at: None}, synchronize_session=False
+        )
+
+
+class CalendarWatcher(object):
+    """ Creates, replaces and stops the users' calendar channels, and records the notifications they send. """
+    def __init__(self, webhook_url: Optional[str] = CALENDAR_WEBHOOK_URL):
+        self.webhook_url = webhook_url
+        self.calendar = CalendarAPIWrapper()
+        self._thread = None
+
+    def watch(self, user: User) -> CalendarChannel:
+        """ Open a channel on the user's primary calendar. Doesn't commit. """
+        channel_id, token = uuid4().hex, secrets.token_urlsafe(32)
+        service = self.calendar.get_service(user)
+        request = service.events().watch(calendarId='primary', body={
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': self.webhook_url,
+            'token': token,
+            'params': {'ttl': str(int(CHANNEL_TTL.total_seconds()))},
+        })
+        response = google_scheduler.call(request.execute, user.id, 'events.watch')
+        channel = CalendarChannel(
+            id=channel_id,
+            user_id=user.id,
+            resource_id=response['resourceId'],
+            token=token,
+            expires_at=datetime.utcfromtimestamp(int(response['expiration']) / 1000),
+        )
+        get_session().add(channel)
+        return channel
+
+    def stop(self, channel: CalendarChannel, user: Optional[User]) -> None:
+        """ Stop a channel and forget it, users who disconnected are left for Google to expire. Doesn't commit. """
+        if user and user.refresh_token:
+            try:
+                request = self.calendar.get_service(user).channels().stop(
+                    body={'id': channel.id, 'resourceId': channel.resource_id})
+                google_scheduler.call(request.execute, user.id, 'channels.stop')
+            except Exception as e:
+                if getattr(getattr(e, 'resp', None), 'status', None) != 404:  # Already gone
+                    logging.warning(f"Failed to stop calendar channel {channel.id} for user {user.id}: {e}")
+        get_session().delete(channel)
+
+    def maintain(self) -> Dict[str, int]:
+        """
+        Watch the calendars of connected users who don't have a channel, replace channels close to expiring, and stop
+        the channels of users who disconnected. Each user is committed separately so one failure doesn't orphan the
+        channels already opened with Google.
+        :return: Counts of channels opened, stopped and failed
+        """
+        counts = {'opened': 0, 'stopped': 0, 'failed': 0}
+        if not self.webhook_url or not self.webhook_url.startswith('https://'):
+            logging.warning(f"Not watching calendars, {self.webhook_url!r} isn't an HTTPS webhook URL.")
+            return counts
+
+        session = get_session()
+        renew_before = datetime.utcnow() + CHANNEL_RENEW_MARGIN
+        connected = and_(User.refresh_token.isnot(None), User.is_deleted.is_(False))
+        live = session.query(CalendarChannel.user_id).filter(CalendarChannel.expires_at > renew_before)
+        for user in session.query(User).filter(connected, User.id.notin_(live)).all():
+            try:
+                self.watch(user)
+                session.commit()
+                counts['opened'] += 1
+            except Exception:
+                session.rollback()
+                counts['failed'] += 1
+                logging.exception(f"Failed to watch the calendar of user {user.id}.")
+
+        # Replacements are already open, so nothing is missed while the old channels are stopped.
+        stale = session.query(CalendarChannel, User).join(User, User.id == CalendarChannel.user_id).filter(
+            or_(CalendarChannel.expires_at <= renew_before, ~connected)
+        ).all()
+        for channel, user in stale:
+            self.stop(channel, user)
+            session.commit()
+            counts['stopped'] += 1
+        logging.info(f"{counts['opened']} calendar channels opened, {counts['stopped']} stopped, "
+                     f"{counts['failed']} failed!")
+        return counts
+
+    def handle_notification(self, headers: Mapping[str, str]) -> bool:
+        """
+        Record a push notification by marking the channel's user as changed. Cheap enough to run in the request.
+        :param headers: The notification's HTTP headers, Google sends nothing else
+        :return: False if it isn't from one of our channels
+        """
+        session = get_session()
+        channel = session.query(CalendarChannel).filter_by(id=headers.get('X-Goog-Channel-ID')).one_or_none()
+        if not channel or not hmac.compare_digest(channel.token, headers.get('X-Goog-Channel-Token', '')):
+            return False
+        # 'sync' is sent once when a channel is opened, not for a change.
+        if headers.get('X-Goog-Resource-State') != 'sync':
+            session.query(User).filter_by(id=channel.user_id).update(
+                {User.calendar_changed_at: datetime.utcnow()}, synchronize_session=False
+            )
+            session.commit()
+        return True
+
+    def start(self) -> None:
+        """ Maintain the channels in a background thread every CHANNEL_MAINTENANCE_SECONDS, starting now. """
+        if self._thread:
+            return
+
+        def run():
+            while True:
+                try:
+                    with track_job('calendar_channels'):
+                        self.maintain()
+                except Exception:
+                    logging.exception("Failed to maintain calendar channels.")
+                finally:
+                    remove_session()
+                time.sleep(CHANNEL_MAINTENANCE_SECONDS)
+
+        self._thread = threading.Thread(target=run, name='calendar-channels', daemon=True)
+        self._thread.start()
+
+
+def simulate(email_address: str, url: str, state: str = 'exists') -> int:
+    """ Post a notification for the user's newest channel to a running app, as Google would. Returns the status. """
+    channel = get_session().query(CalendarChannel).join(User, User.id == CalendarChannel.user_id).filter(
+        User.email_address == email_address).order_by(CalendarChannel.expires_at.desc()).first()
+    if not channel:
+        raise SystemExit(f"{email_address} doesn't have a calendar channel, run maintain first.")
+    request = urllib.request.Request(url, method='POST', headers={
+        'X-Goog-Channel-ID': channel.id,
+        'X-Goog-Channel-Token': channel.token,
+        'X-Goog-Resource-ID': channel.resource_id,
+        'X-Goog-Resource-State': state,
+        'X-Goog-Message-Number': '1',
+    })
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Manage Google Calendar push notification channels.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('maintain', help='Open, replace and stop channels once')
+    simulate_parser = commands.add_parser('simulate', help="Send a fake change notification for a user's calendar")
+    simulate_parser.add_argument('email_address')
+    simulate_parser.add_argument('--url', default='http://localhost:3000/google/calendar/notifications')
+    simulate_parser.add_argument('--state', default='exists', choices=['sync', 'exists', 'not_exists'])
+    args = parser.parse_args()
+    if args.command == 'maintain':
+        print(CalendarWatcher().maintain())
+    else:
+        print(simulate(args.email_address, args.url, args.state))
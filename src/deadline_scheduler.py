@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+from typing import Callable
+import heapq
+import itertools
+import logging
+import threading
+
+
+class DeadlineScheduler(object):
+    """
+    Runs jobs at the time they're due, keeping upcoming deadlines in a min-heap and sleeping until the earliest one
+    instead of polling. Jobs run one at a time on the thread calling run_forever, and can be added from any thread.
+    """
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()  # Tie-breaker so jobs due at the same time run in the order added
+        self._condition = threading.Condition()
+
+    def add(self, due_at: datetime, job: Callable, *args) -> None:
+        """ Run job(*args) at due_at (naive UTC), or as soon as possible if that's already passed. """
+        with self._condition:
+            heapq.heappush(self._heap, (due_at, next(self._counter), job, args))
+            self._condition.notify()
+
+    def every(self, interval: timedelta, job: Callable, *args) -> None:
+        """ Run job(*args) now and then every interval after each run finishes. """
+        def recurring():
+            try:
+                job(*args)
+            finally:
+                self.add(datetime.utcnow() + interval, recurring)
+        self.add(datetime.utcnow(), recurring)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap)
+
+    def run_forever(self) -> None:
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > datetime.utcnow():
+                    if self._heap:
+                        self._condition.wait(max(0.0, (self._heap[0][0] - datetime.utcnow()).total_seconds()))
+                    else:
+                        self._condition.wait()
+                _, _, job, args = heapq.heappop(self._heap)
+            try:
+                job(*args)
+            except Exception:
+                logging.exception(f"Scheduled job {getattr(job, '__name__', job)} failed.")
@@ -0,0 +1,96 @@
+"""
+Skips redundant ingest work for meetings which show up in several connected users' calendars. Within a sync cycle the
+first calendar to return an event claims it and later copies are dropped before any parsing, unless they come from
+the organizer, whose copy populate_events prefers. Across cycles the planner remembers a fingerprint of each event as
+last written to the DB, so an unchanged copy (e.g. every other attendee's change feed repeating one attendee's RSVP
+once it's been ingested) is dropped without touching the DB.
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple
+import os
+import threading
+
+from src import metrics
+
+# Max number of events whose last ingested fingerprint is remembered.
+FETCH_PLANNER_SIZE = int(os.getenv('FETCH_PLANNER_SIZE', 100000))
+
+calendar_events = metrics.Counter('meeting_surveyor_calendar_events_total',
+                                  'Surveyable events returned by Google, by what ingest did with them', ('outcome',))
+
+
+def fingerprint(event: dict) -> int:
+    """ Hash of the raw fields populate_events stores, cheap enough to compute before any parsing. """
+    return hash((
+        event.get('summary'),
+        event.get('description'),
+        event['start'].get('dateTime'),
+        event.get('end', {}).get('dateTime'),
+        event['organizer'].get('email'),
+        tuple((a.get('email'), a.get('responseStatus')) for a in event.get('attendees', ())),
+    ))
+
+
+class FetchPlan(object):
+    """ Claims for one sync cycle, safe to use from the fetch threads. """
+    def __init__(self, planner: 'FetchPlanner'):
+        self.planner = planner
+        self._claims: Dict[str, bool] = {}  # Google event id -> whether the claim came from the organizer
+        self._lock = threading.Lock()
+        self.counts = {'processed': 0, 'duplicate': 0, 'unchanged': 0}
+
+    def should_process(self, event: dict, user_email: str) -> bool:
+        """ Whether this user's copy of the event is worth ingesting. Stores its fingerprint on the event. """
+        is_organizer = event['organizer'].get('email', '').lower() == user_email
+        event['fingerprint'] = fingerprint(event)
+        ingested = self.planner.ingested(event['id'])
+        with self._lock:
+            if ingested and ingested[0] == event['fingerprint'] and (ingested[1] or not is_organizer):
+                outcome = 'unchanged'
+            elif event['id'] in self._claims and (self._claims[event['id']] or not is_organizer):
+                outcome = 'duplicate'
+            else:
+                self._claims[event['id']] = is_organizer
+                outcome = 'processed'
+            self.counts[outcome] += 1
+        calendar_events.inc(outcome)
+        return outcome == 'processed'
+
+    @property
+    def dedup_ratio(self) -> float:
+        """ Fraction of the events returned which were skipped. """
+        seen = sum(self.counts.values())
+        return (seen - self.counts['processed']) / seen if seen else 0.0
+
+
+class FetchPlanner(object):
+    """ Thread-safe LRU of the fingerprint each event had when it was last written to the DB, and by whom. """
+    def __init__(self, max_size: int = FETCH_PLANNER_SIZE):
+        self.max_size = max_size
+        self._ingested = OrderedDict()  # Google event id -> (fingerprint, whether the source was the organizer)
+        self._lock = threading.Lock()
+
+    def plan(self) -> FetchPlan:
+        return FetchPlan(self)
+
+    def ingested(self, google_event_id: str) -> Tuple[int, bool]:
+        with self._lock:
+            return self._ingested.get(google_event_id)
+
+    def record(self, events: Iterable[Tuple[str, int, bool]]) -> None:
+        """ Remember (google event id, fingerprint, from organizer) for events just committed. """
+        with self._lock:
+            for google_event_id, event_fingerprint, from_organizer in events:
+                self._ingested[google_event_id] = (event_fingerprint, from_organizer)
+                self._ingested.move_to_end(google_event_id)
+            while len(self._ingested) > self.max_size:
+                self._ingested.popitem(last=False)
+
+    def forget(self, google_event_ids: Iterable[str]) -> None:
+        with self._lock:
+            for google_event_id in google_event_ids:
+                self._ingested.pop(google_event_id, None)
+
+
+# Shared by every CalendarAPIWrapper in the process.
+fetch_planner = FetchPlanner()
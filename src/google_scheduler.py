@@ -0,0 +1,201 @@
+"""
+Paces every Google API call CalendarAPIWrapper makes against the project's quota and each user's, and retries the
+calls Google rate limits or fails transiently with jittered exponential backoff. When the project's quota is the
+bottleneck, interactive calls (looking an event up while surveying) go ahead of background syncs.
+
+Usage is exported as metrics and by stats(), to size the quota against the number of users.
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, TypeVar
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from google.auth.exceptions import TransportError
+from googleapiclient.errors import HttpError
+from src import metrics
+from src.metrics import track_api_call
+from src.rate_limit import TokenBucket
+
+# Calendar API quota for the whole project, and for each user, in requests per minute. Keep these a little under the
+# quotas in the Google Cloud console.
+GOOGLE_PROJECT_RATE_PER_MINUTE = float(os.getenv('GOOGLE_PROJECT_RATE_PER_MINUTE', 600))
+GOOGLE_PROJECT_BURST = int(os.getenv('GOOGLE_PROJECT_BURST', 50))
+GOOGLE_USER_RATE_PER_MINUTE = float(os.getenv('GOOGLE_USER_RATE_PER_MINUTE', 120))
+GOOGLE_USER_BURST = int(os.getenv('GOOGLE_USER_BURST', 10))
+# Max number of times a rate limited or transiently failed call is retried.
+GOOGLE_MAX_RETRIES = int(os.getenv('GOOGLE_MAX_RETRIES', 5))
+# Retries wait a random time up to BACKOFF_BASE * 2 ** attempt seconds, capped at BACKOFF_CAP.
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 32.0
+# Max number of users whose buckets are kept, the least recently used are dropped (and start full when they're back).
+USER_BUCKETS_SIZE = int(os.getenv('GOOGLE_USER_BUCKETS_SIZE', 10000))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+google_requests = metrics.Counter('meeting_surveyor_google_requests_total',
+                                  'Google API requests let through by the scheduler', ('priority',))
+google_retries = metrics.Counter('meeting_surveyor_google_retries_total', 'Google API requests retried, by reason',
+                                 ('reason',))
+google_quota_wait = metrics.Histogram('meeting_surveyor_google_quota_wait_seconds',
+                                      'Time Google API requests waited for quota', ('priority',))
+
+T = TypeVar('T')
+
+
+def retry_reason(e: Exception) -> Optional[str]:
+    """ Why a failed Google call is worth retrying, or None if it isn't. """
+    if isinstance(e, TransportError):
+        return 'transport_error'
+    if not isinstance(e, HttpError):
+        return None
+    try:
+        errors = json.loads(e.content).get('error', {}).get('errors', [])
+        reasons = {error.get('reason') for error in errors}
+    except (ValueError, AttributeError):
+        reasons = set()
+    if 'userRateLimitExceeded' in reasons:
+        return 'user_rate_limited'
+    if e.resp.status == 429 or reasons & {'rateLimitExceeded', 'quotaExceeded'}:
+        return 'rate_limited'
+    if e.resp.status >= 500:
+        return 'server_error'
+    return None
+
+
+class PriorityGate(object):
+    """ A token bucket whose waiting callers are let through by priority, then in the order they arrived. """
+    def __init__(self, per_minute: float, capacity: int):
+        self.rate = per_minute / 60
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiting = []  # Heap of (priority, arrival)
+        self._arrivals = itertools.count()
+        self._condition = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: int) -> None:
+        with self._condition:
+            ticket = (priority, next(self._arrivals))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._waiting[0] == ticket and now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    heapq.heappop(self._waiting)
+                    self._condition.notify_all()
+                    return
+                self._condition.wait(max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001))
+
+    def pause(self, seconds: float) -> None:
+        """ Hold everyone back, used when Google says the project is over its quota. """
+        with self._condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def stats(self) -> Dict:
+        with self._condition:
+            self._refill(time.monotonic())
+            return {'available': round(self.tokens, 2), 'waiting': len(self._waiting),
+                    'paused_for': round(max(0.0, self.paused_until - time.monotonic()), 2)}
+
+
+class GoogleRequestScheduler(object):
+    """ Runs Google calls on the caller's thread once the user's and then the project's quota allow. """
+    def __init__(self, project_rate: float = GOOGLE_PROJECT_RATE_PER_MINUTE, project_burst: int = GOOGLE_PROJECT_BURST,
+                 user_rate: float = GOOGLE_USER_RATE_PER_MINUTE, user_burst: int = GOOGLE_USER_BURST,
+                 max_retries: int = GOOGLE_MAX_RETRIES):
+        self.project = PriorityGate(project_rate, project_burst)
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_retries = max_retries
+        self._users = OrderedDict()  # User id -> [TokenBucket, requests]
+        self._granted = {name: 0 for name in PRIORITY_NAMES.values()}
+        self._retries: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _user(self, user_id: int) -> list:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = [TokenBucket(self.user_rate, self.user_burst), 0]
+                while len(self._users) > USER_BUCKETS_SIZE:
+                    self._users.popitem(last=False)
+            self._users.move_to_end(user_id)
+            entry[1] += 1
+            return entry
+
+    def call(self, fn: Callable[[], T], user_id: int, endpoint: str, priority: int = BACKGROUND) -> T:
+        """
+        Call fn once there's quota for it, retrying rate limits and transient errors with backoff.
+        :param fn: Makes the request, e.g. an HttpRequest's execute
+        :param user_id: Whose credentials the request uses
+        :param endpoint: For metrics, e.g. 'events.list'
+        :param priority: INTERACTIVE or BACKGROUND
+        """
+        priority_name = PRIORITY_NAMES[priority]
+        for attempt in range(self.max_retries + 1):
+            user_bucket = self._user(user_id)[0]
+            started = time.perf_counter()
+            user_bucket.acquire()
+            self.project.acquire(priority)
+            google_quota_wait.observe(time.perf_counter() - started, priority_name)
+            google_requests.inc(priority_name)
+            with self._lock:
+                self._granted[priority_name] += 1
+            try:
+                with track_api_call('google', endpoint):
+                    return fn()
+            except Exception as e:
+                reason = retry_reason(e)
+                if not reason or attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+                google_retries.inc(reason)
+                with self._lock:
+                    self._retries[reason] = self._retries.get(reason, 0) + 1
+                logging.info(f"Google {endpoint} for user {user_id} failed ({reason}), retrying in {delay:.1f}s.")
+                # Rate limits hold back everyone sharing the quota, not just this call.
+                if reason == 'rate_limited':
+                    self.project.pause(delay)
+                elif reason == 'user_rate_limited':
+                    user_bucket.pause(delay)
+                else:
+                    time.sleep(delay)
+
+    def stats(self, busiest: int = 10) -> Dict:
+        """ Quota usage since startup, with the users making the most requests. """
+        with self._lock:
+            top = sorted(self._users.items(), key=lambda item: -item[1][1])[:busiest]
+            return {
+                'project': {'per_minute': self.project.rate * 60, **self.project.stats()},
+                'granted': dict(self._granted),
+                'retries': dict(self._retries),
+                'users': {
+                    'per_minute': self.user_rate,
+                    'tracked': len(self._users),
+                    'busiest': [{'user_id': user_id, 'requests': requests} for user_id, (_, requests) in top],
+                },
+            }
+
+
+# Shared by every CalendarAPIWrapper in the process, so they share the quota.
+google_scheduler = GoogleRequestScheduler()
+
+metrics.GaugeFunction('meeting_surveyor_google_project_quota_available', 'Google project requests available now',
+                      lambda: google_scheduler.project.stats()['available'])
+metrics.GaugeFunction('meeting_surveyor_google_requests_waiting', 'Google requests waiting for project quota',
+                      lambda: google_scheduler.project.stats()['waiting'])
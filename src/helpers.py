@@ -1,14 +1,33 @@
-from db.database import User
 from sqlalchemy.orm import session as SessionType
-from typing import Optional
+from sqlalchemy.orm.exc import NoResultFound
+from typing import Optional, Iterable, Iterator, List
+
+# SQLite's default limit on bound parameters in one statement, used to chunk large IN queries.
+MAX_SQL_VARIABLES = 999
 
 
 def get_user(session: SessionType, user_id: Optional[int] = None, email_address: Optional[str] = None):
+    """ Look a user up through the shared user directory cache, raising NoResultFound if they don't exist. """
+    from src.user_directory import user_directory  # src.user_directory imports this module.
     if not user_id and not email_address:
         raise ValueError()
 
     if user_id:
-        return session.query(User).filter_by(id=user_id).one()
+        user = user_directory.get_by_id(session, user_id)
     else:
-        return session.query(User).filter_by(email_address=email_address).one()
+        user = user_directory.get_by_email(session, email_address)
+    if not user:
+        raise NoResultFound()
+    return user
+
 
+def chunked(values: Iterable, size: int) -> Iterator[List]:
+    """ Split values into lists of at most size items. """
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
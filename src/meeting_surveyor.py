@@ -1,14 +1,28 @@
-from collections import Counter
-from slack_sdk import WebClient
 import datetime
 import os
 import logging
 from typing import Any
 from src.calendar_api_wrapper import CalendarAPIWrapper
-from db.database import get_session, User, SurveyResponse, Event
-from sqlalchemy import update, and_
-from typing import List
+from db.database import get_session, User, SurveyResponse, Event, SyncCheckpoint
+from sqlalchemy import and_, or_
+from typing import Iterable, List, Optional, Tuple, Dict
+from slack_sdk.errors import SlackApiError
 from src.helpers import get_user
+from src.slack_dispatcher import get_dispatcher
+from src.outbox import enqueue, get_outbox
+from src.tallies import record_response, get_tally
+from src.rollups import MIN_DESCRIPTION_WORDS
+from src.user_directory import user_directory, CachedUser
+from src.worker_leases import in_shards
+
+# Number of members requested per users.list page, Slack recommends no more than 200.
+SLACK_USERS_PAGE_SIZE = 200
+
+# How long after a meeting ends the survey results are sent to the organizer.
+RESULTS_DELAY = datetime.timedelta(hours=1)
+
+# How long before a meeting starts its organizer is sent the notification about it.
+NOTIFICATION_LEAD = datetime.timedelta(days=1)
 
 # Minimum number of non-organizer trialspark employees in a meeting for a survey to be sent.
 MIN_SURVEYABLE = 1 # TODO change to 3
@@ -22,9 +36,11 @@ class MeetingSurveyor(object):
     """
 
     def __init__(self):
-        # Client used in sending messages.
         self.session = get_session()
-        self.client = WebClient(token=os.environ["SLACK_OAUTH_TOKEN"])
+        # All Slack calls go through the shared dispatcher, which paces them to Slack's rate limits.
+        self.slack = get_dispatcher()
+        # Messages are written to the outbox with the DB changes they go with and sent once those are committed.
+        self.outbox = get_outbox()
         self.calendar = CalendarAPIWrapper()
 
     # Kinds/number of ratings preserved will be determined by output of survey?
@@ -32,25 +48,32 @@ class MeetingSurveyor(object):
         """ Store the rating(s) for a survey in the DB """
         response = ''.join(r for r in response if r.isalpha())
         user = self._slack_id_to_user(slack_id)
-        if not user.awaiting_response_on:
-            self.client.chat_postMessage(
+        # Not cached since it changes with every survey sent.
+        awaiting_response_on = self.session.query(User.awaiting_response_on).filter_by(id=user.id).scalar()
+        if not awaiting_response_on:
+            self._send(
                 channel=slack_id,
                 text=f"Sorry, I'm not sure what meeting to assign this rating to."
             )
-        event = self.calendar.get_event(user.awaiting_response_on)
+            self._commit()
+            return
+        event = self.calendar.get_event(awaiting_response_on)
         if response not in SURVEY_RESPONSES:
-            self.client.chat_postMessage(
+            self._send(
                 channel=slack_id,
                 text=f"Sorry, I'm only expecting responses of {', '.join(SURVEY_RESPONSES[:1])} or "
                      f"{SURVEY_RESPONSES[-1]}"
             )
+            self._commit()
+            return
         existing_response = self.session.query(SurveyResponse).filter_by(
-            id=user.awaiting_response_on,
+            event_id=awaiting_response_on,
             user_id=user.id
         ).one_or_none()
         if existing_response:
+            record_response(self.session, event.id, response, previous_response=existing_response.response)
             existing_response.response = response
-            self.client.chat_postMessage(
+            self._send(
                 channel=slack_id,
                 text=f"Updated your rating for meeting {event.name}."
             )
@@ -61,43 +84,40 @@ class MeetingSurveyor(object):
                 response=response
             )
             self.session.add(new_response)
-            self.client.chat_postMessage(
+            record_response(self.session, event.id, response)
+            self._send(
                 channel=slack_id,
                 text=f"Thanks! I've set your rating for meeting {event.name}."
             )
-        self.session.commit()
+        self._commit()
 
-        event_details = self.calendar.get_event_google_details(user.awaiting_response_on)
-        num_responses = len(self.session.query(SurveyResponse).filter_by(event_id=event.id).all())
-        surveyable_attendees = self._get_surveyable_attendees(event, event_details)
+        num_responses = sum(get_tally(self.session, event.id).values())
+        surveyable_attendees = self._get_surveyable_attendees(event)
         if DEMO or num_responses == len(surveyable_attendees):
             self.send_survey_results(event.id)
 
     def send_survey_results(self, event_id):
-        """ Send survey results to the owner """
+        """
+        Send survey results to the owner. Events with no organizer of ours or no responses have nothing to send, but
+        are still marked as done so they aren't picked up again.
+        """
         # Query db to get averages for event, sent results to user.
         event = self.calendar.get_event(event_id)
-        if not event.organizer_id:
-            return
-
-        organizer = self.session.query(User).filter_by(id=event.organizer_id).one()
-        survey_responses = self.session.query(SurveyResponse).filter_by(event_id=event_id)
-        responses = Counter([s.response for s in survey_responses]).most_common()
-        if not responses:
-            return
-
-        message = f'Here are the survey responses for meeting {event.name}:'
-        for response, count in responses:
-            message += f'\n - {count} attendees said "{response}"'
-
-        self.client.chat_postMessage(
-            channel=organizer.slack_id,
-            text=message
-        )
+        responses = get_tally(self.session, event_id).items() if event.organizer_id else []
+        if responses:
+            organizer = user_directory.get_by_id(self.session, event.organizer_id)
+            message = f'Here are the survey responses for meeting {event.name}:'
+            for response, count in responses:
+                message += f'\n - {count} attendees said "{response}"'
+
+            self._send(
+                channel=organizer.slack_id,
+                text=message,
+                idempotency_key=f'survey-results:{event_id}'
+            )
 
-        event = self.session.query(Event).filter_by(id=event_id).first()
-        event.survey_results_sent=True
-        self.session.commit()
+        event.survey_results_sent = True
+        self._commit()
 
     def send_survey_question(self, event_id: int) -> None:
         """
@@ -105,16 +125,17 @@ class MeetingSurveyor(object):
         should_send_survey flag.
         """
         event = self.calendar.get_event(event_id)
-        event_details = self.calendar.get_event_google_details(event_id)
-        surveyable_attendees = self._get_surveyable_attendees(event, event_details)
+        surveyable_attendees = self._get_surveyable_attendees(event)
 
         if len(surveyable_attendees) < MIN_SURVEYABLE:
-            update(Event).where(Event.id == event_id).values(should_send_survey=False)
+            event.should_send_survey = False
+            self.session.commit()
             return
 
-        survey_message = f"Was the meeting \"{event_details['summary']}\" effective? " \
+        survey_message = f"Was the meeting \"{event.name}\" effective? " \
                          f"Response with \"yes\", \"no\", or \"maybe\"."
 
+        surveyed_ids = []
         for attendee in surveyable_attendees:
             if attendee.has_opted_out:
                 continue
@@ -126,76 +147,148 @@ class MeetingSurveyor(object):
                 message += f"\n\n(By the way, if you want to include these surveys on all future meetings just sign up" \
                            f"here, or reply OPT OUT to opt out of future messages: {oauth_link})"
 
-            self.client.chat_postMessage(
+            self._send(
                 channel=attendee.slack_id,
-                text=survey_message
+                text=survey_message,
+                idempotency_key=f'survey-question:{event_id}:{attendee.id}'
             )
-            attendee.awaiting_response_on = event_id
+            surveyed_ids.append(attendee.id)
 
+        if surveyed_ids:
+            self.session.query(User).filter(User.id.in_(surveyed_ids)).update(
+                {User.awaiting_response_on: event_id}, synchronize_session=False
+            )
         event = self.session.query(Event).filter_by(id=event_id).first()
         event.survey_questions_sent = True
-        self.session.commit()
+        self._commit()
 
     def opt_out(self, slack_id: str):
         """ Set the user's opted-out state to True"""
         user = self._slack_id_to_user(slack_id)
-        user.has_opted_out = True
-        self.session.commit()
-        self.client.chat_postMessage(
+        self.session.query(User).filter_by(id=user.id).update({User.has_opted_out: True})
+        self._send(
             channel=user.slack_id,
             text="You've successfully opted out of meeting surveys. If you every want to receive them again in the "
                  "future, just say OPT IN!"
         )
+        self._commit()
+        user_directory.invalidate([user.id])
 
     def opt_in(self, slack_id: str):
         """ If a user opts back into the messages set their opted-out state to False """
         """ Set the user's opted-out state to True"""
         user = self._slack_id_to_user(slack_id)
-        user.has_opted_out = False
-        self.session.commit()
-        self.client.chat_postMessage(
+        self.session.query(User).filter_by(id=user.id).update({User.has_opted_out: False})
+        self._send(
             channel=user.slack_id,
             text="You've successfully opted back into meeting surveys! If you every want to stop getting them in the "
                  "future, just say OPT OUT."
         )
+        self._commit()
+        user_directory.invalidate([user.id])
 
-    def populate_slack_users(self):
+    def populate_slack_users(self, page_size: int = SLACK_USERS_PAGE_SIZE):
         """
-        An method to be executed periodically, gets slack users and adds them to the table so that they may
-        receive invitations to surveys.
+        An method to be executed periodically, walks the Slack directory page by page adding new members, updating
+        changed emails and marking deactivated members so they no longer receive surveys. The cursor is checkpointed
+        after each page so an interrupted run resumes where it stopped.
         """
-        response = self.client.users_list()
-        existing_ids = set(v[0] for v in self.session.query(User.slack_id))
-        slack_team_members = [
-            m for m in response.data['members']
-            if not m['is_bot'] and not m['deleted'] and m.get('profile') and m['profile'].get('email')
-               and m['id'] not in existing_ids
-        ]
-
-        if not slack_team_members:
-            return
-
-        new_users = []
-        for m in slack_team_members:
-            new_users.append(
-                User(
-                    slack_id=m['id'],
-                    email_address=m['profile']['email'].lower(),
-                )
-            )
-
-        self.session.bulk_save_objects(new_users)
-        self.session.commit()
-
-        logging.info(f"{len(new_users)} new slack users added to users table!")
+        checkpoint = self.session.query(SyncCheckpoint).filter_by(name='slack_users').one_or_none()
+        if not checkpoint:
+            checkpoint = SyncCheckpoint(name='slack_users')
+            self.session.add(checkpoint)
+        elif checkpoint.cursor:
+            logging.info("Resuming interrupted Slack user sync.")
+
+        counts = {'inserted': 0, 'updated': 0, 'deactivated': 0}
+        while True:
+            try:
+                response = self.slack.call_now('users_list', limit=page_size, cursor=checkpoint.cursor)
+            except SlackApiError as e:
+                if checkpoint.cursor and e.response.get('error') == 'invalid_cursor':
+                    logging.info("Slack user sync checkpoint expired, starting over.")
+                    checkpoint.cursor = None
+                    continue
+                raise
+            for k, v in self._apply_slack_members(response['members']).items():
+                counts[k] += v
+
+            checkpoint.cursor = response.get('response_metadata', {}).get('next_cursor') or None
+            checkpoint.updated_at = datetime.datetime.utcnow()
+            self.session.commit()
+            if not checkpoint.cursor:
+                break
+
+        if counts['updated'] or counts['deactivated']:
+            user_directory.invalidate()
+
+        logging.info(f"Slack users synced: {counts['inserted']} added, {counts['updated']} updated, "
+                     f"{counts['deactivated']} deactivated!")
+
+    def _apply_slack_members(self, members: List[dict]) -> Dict[str, int]:
+        """ Diff one page of Slack members against the users table and apply the changes in bulk. Doesn't commit. """
+        members = {
+            m['id']: m for m in members
+            if not m['is_bot'] and m.get('profile') and m['profile'].get('email')
+        }
+        existing = {
+            u.slack_id: u for u in self.session.query(User.id, User.slack_id, User.email_address, User.is_deleted)
+            .filter(User.slack_id.in_(members))
+        }
+        emails = {m['profile']['email'].lower() for m in members.values()}
+        owners = {
+            u.email_address: u for u in self.session.query(User.id, User.slack_id, User.email_address, User.is_deleted)
+            .filter(User.email_address.in_(emails))
+        }
+
+        inserts, updates = [], []
+        deactivated = 0
+        claimed = {}  # Email -> the Slack id which has it after this page
+        replaced = set()  # Ids of rows moved to their member's new Slack account
+        for slack_id, m in members.items():
+            email = m['profile']['email'].lower()
+            user = existing.get(slack_id)
+            if user and user.id in replaced:
+                continue  # A deactivated account whose row has been moved to its replacement
+            owner = owners.get(email)
+            claimant = claimed.get(email, owner.slack_id if owner else slack_id)
+            if claimant != slack_id:
+                if owner and claimant == owner.slack_id and not user and not m['deleted'] \
+                        and (owner.is_deleted or members.get(owner.slack_id, {}).get('deleted')):
+                    # The person's old account was deactivated and replaced, move their row across to the new one.
+                    deactivation = next((u for u in updates if u['id'] == owner.id), None)
+                    if deactivation:  # The old account came earlier in this page
+                        updates.remove(deactivation)
+                        deactivated -= 1
+                    updates.append({'id': owner.id, 'slack_id': slack_id, 'email_address': email, 'is_deleted': False})
+                    replaced.add(owner.id)
+                    claimed[email] = slack_id
+                else:
+                    logging.warning(f"Skipping Slack user {slack_id}, {email} already belongs to {claimant}.")
+                continue
+            claimed[email] = slack_id
+            if not user:
+                if not m['deleted']:
+                    inserts.append({'slack_id': slack_id, 'email_address': email})
+            elif user.email_address != email or user.is_deleted != m['deleted']:
+                updates.append({'id': user.id, 'email_address': email, 'is_deleted': m['deleted']})
+                deactivated += m['deleted'] and not user.is_deleted
+
+        self.session.bulk_insert_mappings(User, inserts)
+        self.session.bulk_update_mappings(User, updates)
+        return {'inserted': len(inserts), 'updated': len(updates) - deactivated, 'deactivated': deactivated}
 
     def update_user(self, user_info: dict, tokens: dict):
         user = self.session.query(User).where(User.email_address == user_info['email']).one_or_none()
 
         if user:
-            if tokens.get('refresh_token'):
+            if tokens.get('refresh_token') and tokens['refresh_token'] != user.refresh_token:
                 user.refresh_token = tokens['refresh_token']
+                # Any stored access token belongs to the old grant.
+                user.access_token = None
+                user.access_token_expires_at = None
             self.session.commit()
+            user_directory.invalidate([user.id])
         else:
             raise Exception("Attempted to update user who does not exist in the table. All users with slack accounts"
                             " are expected to exist in periodically updated table, this is an unforeseen state.")
@@ -210,71 +303,129 @@ class MeetingSurveyor(object):
         if user and not user.refresh_token:
             message += f"\n\nIf you want to include these surveys on all your future meetings just sign up here, " \
                        f" {oauth_link}"
-        self.client.chat_postMessage(
+        self._send(
             channel=user.slack_id,
             text=message
         )
+        self._commit()
         
     def send_error(self, slack_id: str, user_message: str) -> None:
         """ Send an error on an unhandled submission """
         user = self._slack_id_to_user(slack_id)
         if user:
-            self.client.chat_postMessage(
+            self._send(
                 channel=slack_id,
                 text=f"Sorry, I don't know how to respond to \"{user_message}\"."
             )
+            self._commit()
+
+    def send_pending_notifications(self, shards: Optional[Iterable[int]] = None) -> int:
+        """
+        Notify organizers about their meetings starting within NOTIFICATION_LEAD which they haven't been told about.
+        Meetings which have already started by the time they're seen are marked as notified without sending anything.
+        :param shards: Only events in these worker shards
+        :return: The number of events looked at
+        """
+        now = datetime.datetime.utcnow()
+        query = self.session.query(Event).filter(
+            Event.notification_sent.is_(False),
+            Event.start_datetime <= now + NOTIFICATION_LEAD,
+        )
+        if shards is not None:
+            query = query.filter(in_shards(Event.id, shards))
+        events = query.all()
+        for event in events:
+            event.notification_sent = True
+            if event.organizer_id and not event.is_cancelled and event.start_datetime > now:
+                self.send_event_notification(event)  # Commits with the flag
+        self._commit()
+        return len(events)
 
     def send_event_notification(self, event: Event):
         """ Send a message to the owner about their event """
-        organizer = self.session.query(User).filter_by(id=event.organizer_id).one()
+        organizer = user_directory.get_by_id(self.session, event.organizer_id)
         if organizer.refresh_token and not organizer.has_opted_out:  # Only for organizers who have opted in
 
             text = f'Some information for your upcoming meeting {event.name}:'
 
-            if not event.description:
-                words_in_description = 0
-            else:
-                zoom_break = '──────'  # Not in regular messages, before zoom section of description.
-                words_in_description = len([v for v in event.description.split(zoom_break)[0].strip().split(' ')
-                                           if v.strip().isalpha()])
-
+            # Word count and cost are worked out when the event is ingested, see src/rollups.py
+            words_in_description = event.description_words
             if not words_in_description:
                 text += '\n - It looks like this event doesn\'t have a description, please add one!'
-            elif words_in_description < 12:
+            elif words_in_description < MIN_DESCRIPTION_WORDS:
                 text += f'\n - I only see {words_in_description} words in this description, consider adding more ' \
                         f'detail before the meeting starts!'
 
-            average_salary = 106723.00  # average for tech workers, going lower bound than NYC average to be conservative
-            cost_per_hour = event.num_attendees * (average_salary / 261 / 8)
-            meeting_length = event.end_datetime - event.start_datetime
-            meeting_cost = (meeting_length.total_seconds()/3600) * cost_per_hour
-
             text += f'\n - With {event.num_attendees} people invited, based off market averages this meeting ' \
-                    f'costs ${round(meeting_cost, 2)}. '
+                    f'costs ${round(event.cost or 0, 2)}. '
 
-            self.client.chat_postMessage(
+            self._send(
                 channel=organizer.slack_id,
-                text=text
+                text=text,
+                idempotency_key=f'event-notification:{event.google_event_id}'
             )
+            self._commit()
+
+    def _send(self, channel: str, text: str, idempotency_key: Optional[str] = None) -> None:
+        """ Queue a Slack message, it goes out once the current transaction is committed with _commit. """
+        enqueue(self.session, channel, text, idempotency_key)
+
+    def _commit(self) -> None:
+        self.session.commit()
+        self.outbox.notify()
 
-    def _slack_id_to_user(self, slack_id: str):
-        return self.session.query(User).filter_by(slack_id=slack_id).first()
+    def _slack_id_to_user(self, slack_id: str) -> Optional[CachedUser]:
+        return user_directory.get_by_slack_id(self.session, slack_id)
 
-    def _get_surveyable_attendees(self, event: Event, event_details: dict) -> List[User]:
-        attendee_emails = [a['email'].lower() for a in event_details['attendees'] if
+    def _get_surveyable_attendees(self, event: Event) -> List[CachedUser]:
+        attendee_emails = [a['email'] for a in self.calendar.get_event_attendees(event) if
                            (a['email'] == event.organizer_email if DEMO else a['email'] != event.organizer_email)
                            and a['responseStatus'] != 'declined']
-        surveyable_attendees = self.session.query(User).filter(
-            User.email_address.in_(attendee_emails)
-        ).all()
+        surveyable_attendees = [
+            u for u in user_directory.get_many_by_email(self.session, attendee_emails) if not u.is_deleted
+        ]
         return surveyable_attendees
 
+    def get_deadlines(self, event_ids: Optional[List[int]] = None, google_event_ids: Optional[List[str]] = None,
+                      shards: Optional[Iterable[int]] = None, due_before: Optional[datetime.datetime] = None) \
+            -> List[Tuple[datetime.datetime, str, int]]:
+        """
+        Get when the next survey step is due for pending events: the question when the meeting ends and the results
+        RESULTS_DELAY after that.
+        :param event_ids: Only look at these events
+        :param google_event_ids: Only look at these events
+        :param shards: Only look at events in these worker shards
+        :param due_before: Only steps due before this
+        :return: (due at, 'question' or 'results', event id) tuples
+        """
+        query = self.session.query(Event.id, Event.end_datetime, Event.survey_questions_sent).filter(
+            and_(
+                Event.should_send_survey.is_(True),
+                Event.survey_results_sent.is_(False),
+            )
+        )
+        if event_ids is not None:
+            query = query.filter(Event.id.in_(event_ids))
+        if google_event_ids is not None:
+            query = query.filter(Event.google_event_id.in_(google_event_ids))
+        if shards is not None:
+            query = query.filter(in_shards(Event.id, shards))
+        if due_before is not None:
+            query = query.filter(or_(
+                and_(Event.survey_questions_sent.is_(False), Event.end_datetime < due_before),
+                and_(Event.survey_questions_sent.is_(True), Event.end_datetime < due_before - RESULTS_DELAY),
+            ))
+        return [
+            (end + RESULTS_DELAY, 'results', event_id) if questions_sent else (end, 'question', event_id)
+            for event_id, end, questions_sent in query
+        ]
+
     def send_pending_questions(self):
         pending_events = self.session.query(Event).filter(
             and_(
-                # Event.end_datetime < datetime.datetime.utcnow(),
-                not Event.survey_questions_sent,
-                Event.should_send_survey
+                Event.survey_questions_sent.is_(False),
+                Event.should_send_survey.is_(True),
+                Event.end_datetime < datetime.datetime.utcnow(),
             )
         ).all()
         for event in pending_events:
@@ -283,9 +434,9 @@ class MeetingSurveyor(object):
     def send_pending_results(self):
         pending_events = self.session.query(Event).filter(
             and_(
-                Event.end_datetime < datetime.datetime.utcnow() + datetime.timedelta(0, 3600),  # one hour after over
-                Event.survey_questions_sent,
-                Event.survey_results_sent
+                Event.survey_results_sent.is_(False),
+                Event.survey_questions_sent.is_(True),
+                Event.end_datetime < datetime.datetime.utcnow() - RESULTS_DELAY,
             )
         ).all()
         for event in pending_events:
@@ -0,0 +1,188 @@
+"""
+Minimal Prometheus-style metrics: counters and histograms with labels, rendered in the text exposition format for the
+Flask /metrics route, or served on their own port by the scheduler with serve(). Also tracks which job the current
+thread is running so DB queries and API calls can be attributed to it.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry: List['_Metric'] = []
+_registry_lock = threading.Lock()
+_current = threading.local()
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric(object):
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}'] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f'{self.name}{_format_labels(self.labels, k)} {v}' for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        with self._lock:
+            counts, total, count = self._values.get(label_values, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[label_values] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for k, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    le = f'le="{bound}"'
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labels, k, le)} {bucket_count}')
+                le = 'le="+Inf"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, k, le)} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labels, k)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.labels, k)} {count}')
+        return lines
+
+
+class GaugeFunction(_Metric):
+    """ A gauge whose value is read from a function whenever metrics are rendered. """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], float]):
+        super().__init__(name, help_text)
+        self.fn = fn
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name} {self.fn()}']
+
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+job_duration = Histogram('meeting_surveyor_job_duration_seconds', 'Time taken by scheduled jobs', ('job',))
+job_failures = Counter('meeting_surveyor_job_failures_total', 'Scheduled jobs which raised', ('job',))
+api_request_duration = Histogram('meeting_surveyor_api_request_duration_seconds',
+                                 'Latency of Slack and Google API calls', ('api', 'endpoint', 'outcome'))
+db_query_duration = Histogram('meeting_surveyor_db_query_duration_seconds', 'Time spent in SQL statements per job',
+                              ('job',))
+
+
+def current_job() -> str:
+    return getattr(_current, 'job', 'none')
+
+
+@contextmanager
+def track_job(name: str) -> Iterator[None]:
+    """ Time a job, attributing everything the current thread does meanwhile (DB queries) to it. """
+    previous = current_job()
+    _current.job = name
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        job_failures.inc(name)
+        raise
+    finally:
+        job_duration.observe(time.perf_counter() - started, name)
+        _current.job = previous
+
+
+@contextmanager
+def track_api_call(api: str, endpoint: str) -> Iterator[None]:
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except Exception as e:
+        # Slack errors carry the HTTP response as .response, Google's as .resp
+        status = getattr(getattr(e, 'response', None), 'status_code', None) or \
+            getattr(getattr(e, 'resp', None), 'status', None)
+        outcome = {304: 'not_modified', 429: 'rate_limited'}.get(status, 'error')
+        raise
+    finally:
+        api_request_duration.observe(time.perf_counter() - started, api, endpoint, outcome)
+
+
+def instrument_engine(engine) -> None:
+    """ Count and time every SQL statement run on an engine, labelled with the job running it. """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        db_query_duration.observe(time.perf_counter() - context.metrics_started, current_job())
+
+
+def serve(port: int) -> None:
+    """ Serve /metrics from a background thread, for processes without a Flask app. """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200 if self.path == '/metrics' else 404)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.end_headers()
+            self.wfile.write(body if self.path == '/metrics' else b'')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
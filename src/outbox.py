@@ -0,0 +1,184 @@
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from uuid import uuid4
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from db.database import get_session, remove_session, OutboxMessage
+from src.slack_dispatcher import SlackDispatcher, get_dispatcher
+from src.metrics import track_job
+import logging
+import os
+import threading
+
+# Max number of messages claimed and sent per batch.
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+# Messages which fail this many times are dead-lettered and left for someone to look at.
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+# How often the background drain checks for due messages when nothing has woken it up.
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', 5))
+# A claim older than this is assumed to belong to a drain that died, and its messages are sent again.
+CLAIM_TIMEOUT = timedelta(minutes=5)
+# Sent and dead-lettered messages are kept this long, only to stop the same idempotency key being queued twice. Survey
+# steps are done within hours of a meeting ending, so nothing still running queues a key this old again.
+OUTBOX_RETENTION = timedelta(days=int(os.getenv('OUTBOX_RETENTION_DAYS', 30)))
+# Messages deleted per transaction when pruning.
+OUTBOX_PRUNE_BATCH_SIZE = int(os.getenv('OUTBOX_PRUNE_BATCH_SIZE', 500))
+# Dialects whose INSERT supports ON CONFLICT DO NOTHING, enqueue falls back to a savepoint on any others.
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def enqueue(session: Session, channel: str, text: str, idempotency_key: Optional[str] = None) -> None:
+    """
+    Queue a Slack message as part of the session's current transaction, nothing is sent until it's committed. A
+    message whose idempotency_key has already been queued is dropped, so re-running a job doesn't send twice. That
+    includes one queued by a concurrent transaction, without failing the caller's transaction.
+    """
+    values = {'idempotency_key': idempotency_key or uuid4().hex, 'channel': channel, 'text': text}
+    insert = UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if insert:
+        session.execute(insert(OutboxMessage).values(**values).on_conflict_do_nothing(
+            index_elements=[OutboxMessage.idempotency_key]
+        ))
+        return
+    if session.query(OutboxMessage.id).filter_by(idempotency_key=values['idempotency_key']).first():
+        return
+    session.flush()  # So a failure in the caller's own changes isn't mistaken for a duplicate below
+    try:
+        with session.begin_nested():
+            session.add(OutboxMessage(**values))
+    except IntegrityError:
+        logging.info(f"Outbox message {values['idempotency_key']} was queued by another transaction, dropping it.")
+
+
+def prune_outbox(session: Optional[Session] = None, retention: timedelta = OUTBOX_RETENTION,
+                 batch_size: int = OUTBOX_PRUNE_BATCH_SIZE) -> int:
+    """
+    Delete sent and dead-lettered messages queued more than retention ago, a batch per transaction.
+    :return: The number of messages deleted
+    """
+    session = session or get_session()
+    cutoff = datetime.utcnow() - retention
+    deleted = 0
+    while True:
+        ids = [row.id for row in session.query(OutboxMessage.id).filter(
+            OutboxMessage.status.in_(['sent', 'dead']), OutboxMessage.created_at < cutoff
+        ).limit(batch_size)]
+        if not ids:
+            return deleted
+        session.query(OutboxMessage).filter(OutboxMessage.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+        deleted += len(ids)
+
+
+class OutboxDispatcher(object):
+    """
+    Drains the outbox in batches through the Slack dispatcher. Batches are claimed with a conditional update so several
+    processes can drain the same table, failed messages are retried with exponential backoff and dead-lettered after
+    OUTBOX_MAX_ATTEMPTS.
+    """
+    def __init__(self, slack: SlackDispatcher, batch_size: int = OUTBOX_BATCH_SIZE,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.slack = slack
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _claim_batch(self, session: Session) -> str:
+        now = datetime.utcnow()
+        claimable = or_(
+            and_(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= now),
+            and_(OutboxMessage.status == 'sending', OutboxMessage.claimed_at < now - CLAIM_TIMEOUT),
+        )
+        ids = [row.id for row in session.query(OutboxMessage.id).filter(claimable)
+               .order_by(OutboxMessage.id).limit(self.batch_size)]
+        claim = uuid4().hex
+        if ids:
+            # Only rows still claimable get our claim, another process may have taken some in the meantime.
+            session.query(OutboxMessage).filter(and_(OutboxMessage.id.in_(ids), claimable)).update(
+                {'status': 'sending', 'claimed_by': claim, 'claimed_at': now}, synchronize_session=False
+            )
+        session.commit()
+        return claim
+
+    def drain_batch(self, session: Session) -> Dict[str, int]:
+        """
+        Claim and send one batch of due messages.
+        :return: Counts of messages sent, retried and dead-lettered
+        """
+        claim = self._claim_batch(session)
+        messages = session.query(OutboxMessage).filter_by(claimed_by=claim, status='sending').all()
+        sends = [(m, self.slack.call('chat_postMessage', channel=m.channel, text=m.text)) for m in messages]
+        self.slack.wait(f for _, f in sends)
+
+        counts = {'sent': 0, 'retried': 0, 'dead': 0}
+        now = datetime.utcnow()
+        for message, future in sends:
+            message.attempts += 1
+            if not future.exception():
+                message.status = 'sent'
+                message.sent_at = now
+                counts['sent'] += 1
+                continue
+            message.last_error = str(future.exception())
+            if message.attempts >= self.max_attempts:
+                message.status = 'dead'
+                counts['dead'] += 1
+                logging.error(f"Giving up on outbox message {message.idempotency_key}: {message.last_error}")
+            else:
+                message.status = 'pending'
+                message.next_attempt_at = now + timedelta(seconds=2 ** message.attempts)
+                counts['retried'] += 1
+        session.commit()
+        return counts
+
+    def drain(self) -> Dict[str, int]:
+        """ Send batches until nothing is due. """
+        session = get_session()
+        totals = {'sent': 0, 'retried': 0, 'dead': 0}
+        try:
+            while True:
+                counts = self.drain_batch(session)
+                for k, v in counts.items():
+                    totals[k] += v
+                if not any(counts.values()):
+                    return totals
+        finally:
+            remove_session()
+
+    def notify(self) -> None:
+        """ Wake the background drain, call after committing new messages. """
+        self._wake.set()
+
+    def start(self) -> None:
+        """ Drain in a background thread whenever notified, and every OUTBOX_POLL_SECONDS to pick up retries. """
+        if self._thread:
+            return
+
+        def run():
+            while True:
+                self._wake.wait(OUTBOX_POLL_SECONDS)
+                self._wake.clear()
+                try:
+                    with track_job('outbox_drain'):
+                        self.drain()
+                except Exception:
+                    logging.exception("Failed to drain the outbox.")
+
+        self._thread = threading.Thread(target=run, name='outbox', daemon=True)
+        self._thread.start()
+
+
+_outbox: Optional[OutboxDispatcher] = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> OutboxDispatcher:
+    """ The process-wide outbox dispatcher. """
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = OutboxDispatcher(get_dispatcher())
+        return _outbox
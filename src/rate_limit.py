@@ -0,0 +1,31 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket, acquire blocks until a token is available. """
+    def __init__(self, per_minute: float, capacity: int):
+        self.rate = per_minute / 60
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait_for)
+
+    def pause(self, seconds: float) -> None:
+        """ Hold back every caller, e.g. when the API tells us to back off. """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
@@ -0,0 +1,220 @@
+"""
+Retention for events and survey responses. Events which ended more than RETENTION_DAYS ago are written, with their
+responses, to gzipped JSON Lines files in ARCHIVE_DIR, one file per run. Each gets a row in event_summaries with its
+response counts for reporting, and is then deleted along with its responses and tallies. Freed pages are handed back
+to the filesystem with SQLite's incremental vacuum, a chunk at a time so other writers aren't locked out for long.
+Archiving doesn't touch the weekly rollups in src/rollups.py, which go on reporting on the archived meetings.
+
+A batch is only deleted once its archive lines are on disk. If a run dies in between, the same events are archived
+again by the next run; the reader keeps the last copy of each event.
+
+    python3 -m src.retention archive
+    python3 -m src.retention query --organizer-email someone@example.com --since 2021-01-01 --count
+    python3 -m src.retention enable-incremental-vacuum   # Once, for databases created before this was set up
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from db.database import get_engine, get_session, Event, EventSummary, SurveyResponse, SurveyTally, User
+from src.helpers import chunked, MAX_SQL_VARIABLES
+
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 365))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'db/archive')
+# Events archived and deleted per transaction.
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 500))
+# Pages released per incremental vacuum step.
+VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', 2000))
+
+_EVENT_COLUMNS = [c.name for c in Event.__table__.columns]
+
+
+def _to_json(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class Archiver(object):
+    """ Moves old events and their responses from the DB to archive files, keeping a summary row per event. """
+    def __init__(self, session: Optional[Session] = None, archive_dir: str = ARCHIVE_DIR,
+                 retention: timedelta = timedelta(days=RETENTION_DAYS), batch_size: int = RETENTION_BATCH_SIZE):
+        self.session = session or get_session()
+        self.archive_dir = archive_dir
+        self.retention = retention
+        self.batch_size = batch_size
+
+    def run(self) -> Dict[str, int]:
+        """
+        Archive everything past retention, then vacuum.
+        :return: Counts of events and responses archived, and pages vacuumed
+        """
+        cutoff = datetime.utcnow() - self.retention
+        counts = {'events': 0, 'responses': 0, 'pages_vacuumed': 0}
+        path = None
+        archive = None
+        try:
+            while True:
+                events = self.session.query(Event).filter(Event.end_datetime < cutoff) \
+                    .order_by(Event.id).limit(self.batch_size).all()
+                if not events:
+                    break
+                if archive is None:
+                    os.makedirs(self.archive_dir, exist_ok=True)
+                    path = os.path.join(self.archive_dir, f"events-{datetime.utcnow():%Y%m%d-%H%M%S}.jsonl.gz")
+                    archive = gzip.open(path, 'ab')
+                counts['responses'] += self._archive_batch(events, archive, os.path.basename(path))
+                counts['events'] += len(events)
+        finally:
+            if archive is not None:
+                archive.close()
+        counts['pages_vacuumed'] = self.vacuum()
+        logging.info(f"{counts['events']} events and {counts['responses']} responses archived to {path}, "
+                     f"{counts['pages_vacuumed']} pages vacuumed!")
+        return counts
+
+    def _archive_batch(self, events: List[Event], archive: gzip.GzipFile, archive_file: str) -> int:
+        event_ids = [e.id for e in events]
+        responses: Dict[int, List[dict]] = {event_id: [] for event_id in event_ids}
+        tallies: Dict[int, Dict[str, int]] = {event_id: {} for event_id in event_ids}
+        for chunk in chunked(event_ids, MAX_SQL_VARIABLES):
+            for r in self.session.query(SurveyResponse).filter(SurveyResponse.event_id.in_(chunk)):
+                responses[r.event_id].append({'id': r.id, 'user_id': r.user_id, 'response': r.response})
+            for t in self.session.query(SurveyTally).filter(SurveyTally.event_id.in_(chunk)):
+                tallies[t.event_id][t.response] = t.count
+
+        for event in events:
+            record = {column: _to_json(getattr(event, column)) for column in _EVENT_COLUMNS}
+            record['responses'] = responses[event.id]
+            archive.write((json.dumps(record) + '\n').encode())
+        # The lines have to be on disk before the rows they replace are deleted.
+        archive.flush()
+        os.fsync(archive.fileobj.fileno())
+
+        self.session.bulk_insert_mappings(EventSummary, [{
+            'event_id': e.id,
+            'google_event_id': e.google_event_id,
+            'name': e.name,
+            'organizer_id': e.organizer_id,
+            'organizer_email': e.organizer_email,
+            'start_datetime': e.start_datetime,
+            'end_datetime': e.end_datetime,
+            'num_attendees': e.num_attendees,
+            'is_cancelled': e.is_cancelled,
+            'duration_minutes': e.duration_minutes,
+            'cost': e.cost,
+            'description_words': e.description_words,
+            'responses': tallies[e.id],
+            'archive_file': archive_file,
+        } for e in events])
+        for chunk in chunked(event_ids, MAX_SQL_VARIABLES):
+            self.session.query(SurveyResponse).filter(SurveyResponse.event_id.in_(chunk)) \
+                .delete(synchronize_session=False)
+            self.session.query(SurveyTally).filter(SurveyTally.event_id.in_(chunk)).delete(synchronize_session=False)
+            self.session.query(User).filter(User.awaiting_response_on.in_(chunk)).update(
+                {User.awaiting_response_on: None}, synchronize_session=False
+            )
+            self.session.query(Event).filter(Event.id.in_(chunk)).delete(synchronize_session=False)
+        self.session.commit()
+        self.session.expunge_all()
+        return sum(len(r) for r in responses.values())
+
+    @staticmethod
+    def vacuum(pages: int = VACUUM_PAGES) -> int:
+        """
+        Release the free pages left by deletes back to the filesystem, pages at a time with each step in its own
+        transaction. Does nothing on databases without incremental auto_vacuum.
+        :return: The number of pages released
+        """
+        engine = get_engine()
+        if engine.dialect.name != 'sqlite':
+            return 0
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if connection.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+                logging.warning("The database doesn't use incremental auto_vacuum, so deleted rows don't shrink the "
+                                "file. Run `python3 -m src.retention enable-incremental-vacuum` once to convert it.")
+                return 0
+            initial = free = connection.execute(text('PRAGMA freelist_count')).scalar()
+            while free:
+                # A plain execute only steps the pragma once, which frees a single page. executescript runs it to
+                # completion.
+                connection.connection.executescript(f'PRAGMA incremental_vacuum({pages})')
+                remaining = connection.execute(text('PRAGMA freelist_count')).scalar()
+                if remaining >= free:
+                    break
+                free = remaining
+            return initial - free
+
+
+def enable_incremental_vacuum() -> None:
+    """ Switch an existing SQLite database to incremental auto_vacuum, a full VACUUM which locks it while it runs. """
+    with get_engine().connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('PRAGMA auto_vacuum=INCREMENTAL'))
+        connection.execute(text('VACUUM'))
+
+
+def read_archive(archive_dir: str = ARCHIVE_DIR) -> Iterator[dict]:
+    """
+    Every archived event with its responses, oldest archive first. An event archived twice (by a run which died
+    before deleting it) is only returned once, with its last copy. A file cut short by a crash is read up to the break.
+    """
+    events = {}
+    for path in sorted(glob.glob(os.path.join(archive_dir, 'events-*.jsonl.gz'))):
+        with gzip.open(path, 'rt') as f:
+            try:
+                for line in f:
+                    event = json.loads(line)
+                    events[event['id']] = event
+            except (EOFError, json.JSONDecodeError):
+                logging.warning(f"{path} is truncated, reading what's there.")
+    return iter(events.values())
+
+
+def query_archive(archive_dir: str = ARCHIVE_DIR, organizer_email: Optional[str] = None,
+                  since: Optional[str] = None, until: Optional[str] = None) -> Iterator[dict]:
+    """ Archived events filtered by organizer and/or an ISO date range on the meeting's start. """
+    for event in read_archive(archive_dir):
+        if organizer_email and event['organizer_email'] != organizer_email.lower():
+            continue
+        if since and (event['start_datetime'] or '') < since:
+            continue
+        if until and (event['start_datetime'] or '') >= until:
+            continue
+        yield event
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Archive old events, or query the archive.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('archive', help='Archive events which ended more than RETENTION_DAYS ago')
+    commands.add_parser('enable-incremental-vacuum', help='Convert an existing database, locks it while it runs')
+    query_parser = commands.add_parser('query', help='Print archived events as JSON lines')
+    query_parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    query_parser.add_argument('--organizer-email')
+    query_parser.add_argument('--since', help='ISO date, inclusive')
+    query_parser.add_argument('--until', help='ISO date, exclusive')
+    query_parser.add_argument('--count', action='store_true', help='Print totals instead of the events')
+    args = parser.parse_args()
+
+    if args.command == 'archive':
+        print(Archiver().run())
+    elif args.command == 'enable-incremental-vacuum':
+        enable_incremental_vacuum()
+    else:
+        matches = query_archive(args.archive_dir, args.organizer_email, args.since, args.until)
+        if not args.count:
+            for event in matches:
+                print(json.dumps(event))
+        else:
+            totals = {'events': 0, 'responses': {}}
+            for event in matches:
+                totals['events'] += 1
+                for r in event['responses']:
+                    totals['responses'][r['response']] = totals['responses'].get(r['response'], 0) + 1
+            print(json.dumps(totals))
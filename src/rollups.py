@@ -0,0 +1,342 @@
+"""
+Meeting cost and effectiveness per organizer per week. Each event's duration, cost, description length and whether
+it's a Zoom meeting are worked out once when it's ingested, and every event and survey response is counted in its
+organizer's row for the week (Monday, UTC) the meeting starts in, in the same transaction as the change itself.
+Reports only read those rows, so they cost the same however many meetings there are, and cover events src/retention.py
+has since archived.
+
+Run this module to recompute the rollups from the events, archive summaries and tallies, it reports any weeks which
+had drifted:
+
+    python3 -m src.rollups [--check]
+"""
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple, Union
+import argparse
+import logging
+import os
+
+from sqlalchemy import and_, bindparam, func, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from db.database import get_session, Event, EventSummary, OrganizerWeek, OrganizerWeekResponse, SurveyTally
+from src.helpers import chunked, MAX_SQL_VARIABLES
+
+# Average salary for tech workers, going lower bound than the NYC average to be conservative.
+AVERAGE_SALARY = float(os.getenv('AVERAGE_SALARY', 106723.00))
+WORKING_HOURS_PER_YEAR = 261 * 8
+# Descriptions with fewer words get a nudge in the organizer's notification, and count as undescribed.
+MIN_DESCRIPTION_WORDS = 12
+ZOOM_BREAK = '──────'  # Not in regular messages, before the Zoom section of a description.
+# The answer to "Was the meeting effective?" counted towards effectiveness.
+EFFECTIVE_RESPONSE = 'yes'
+# Weeks covered by a report when it isn't given a range.
+REPORT_WEEKS = int(os.getenv('REPORT_WEEKS', 4))
+# Organizers listed in the org-wide report, costliest first.
+REPORT_ORGANIZERS = int(os.getenv('REPORT_ORGANIZERS', 50))
+
+# The Event (and EventSummary) columns an event's contribution to the rollups is worked out from.
+ROLLUP_COLUMNS = ('organizer_email', 'start_datetime', 'duration_minutes', 'cost', 'description_words', 'is_cancelled')
+MEETING_TOTALS = ('meetings', 'minutes', 'cost', 'undescribed_meetings')
+
+WeekKey = Tuple[str, date]
+
+
+def meeting_stats(start: datetime, end: datetime, num_attendees: int) -> Dict:
+    """ The derived Event fields which change with the meeting's time and size. """
+    hours = (end - start).total_seconds() / 3600
+    return {
+        'duration_minutes': round(hours * 60),
+        'cost': num_attendees * AVERAGE_SALARY / WORKING_HOURS_PER_YEAR * hours,
+    }
+
+
+def description_stats(description: Optional[str], has_conference: bool) -> Dict:
+    """ The derived Event fields which come from its description. """
+    words = 0
+    if description:
+        words = len([v for v in description.split(ZOOM_BREAK)[0].strip().split(' ') if v.strip().isalpha()])
+    return {
+        'description_words': words,
+        'is_zoom': has_conference or 'Zoom' in (description or ''),
+    }
+
+
+def week_of(dt: Union[datetime, date]) -> date:
+    """ The Monday of dt's week. """
+    day = dt.date() if isinstance(dt, datetime) else dt
+    return day - timedelta(days=day.weekday())
+
+
+def _week_key(event) -> WeekKey:
+    return event.organizer_email, week_of(event.start_datetime)
+
+
+class RollupBatch(object):
+    """
+    Changes to the rollups collected in memory and written with one statement per organizer week, so a sync's worth
+    of events doesn't cost a statement each. Events are anything with the ROLLUP_COLUMNS as attributes.
+    """
+    def __init__(self):
+        self.meetings: Dict[WeekKey, Counter] = defaultdict(Counter)
+        self.responses: Dict[Tuple[str, date, str], int] = Counter()
+        self._moved: Dict[int, Tuple[WeekKey, WeekKey]] = {}  # Event id -> (old week, new week)
+
+    def add_event(self, event, sign: int = 1) -> None:
+        """ Count an event, or uncount it with sign=-1. Cancelled events aren't counted. """
+        if event.is_cancelled or not event.start_datetime:
+            return
+        totals = self.meetings[_week_key(event)]
+        totals['meetings'] += sign
+        totals['minutes'] += sign * (event.duration_minutes or 0)
+        totals['cost'] += sign * (event.cost or 0)
+        if event.description_words is not None and event.description_words < MIN_DESCRIPTION_WORDS:
+            totals['undescribed_meetings'] += sign
+
+    def update_event(self, event_id: int, old, changes: Dict) -> None:
+        """ Recount an event whose row is being updated, moving its responses if it moved to another week. """
+        new = SimpleNamespace(**{column: changes.get(column, getattr(old, column)) for column in ROLLUP_COLUMNS})
+        self.add_event(old, -1)
+        self.add_event(new)
+        if old.start_datetime and new.start_datetime and _week_key(old) != _week_key(new):
+            self._moved[event_id] = (_week_key(old), _week_key(new))
+
+    def add_responses(self, organizer_email: str, start: datetime, response: str, count: int = 1) -> None:
+        self.responses[(organizer_email, week_of(start), response)] += count
+
+    def apply(self, session: Session) -> None:
+        """ Write the changes collected so far. Doesn't commit. """
+        for chunk in chunked(list(self._moved), MAX_SQL_VARIABLES):
+            for event_id, response, count in session.query(SurveyTally.event_id, SurveyTally.response,
+                                                           SurveyTally.count).filter(SurveyTally.event_id.in_(chunk)):
+                (old_email, old_week), (new_email, new_week) = self._moved[event_id]
+                self.responses[(old_email, old_week, response)] -= count
+                self.responses[(new_email, new_week, response)] += count
+
+        for (organizer_email, week_start), totals in self.meetings.items():
+            deltas = {k: v for k, v in totals.items() if v}
+            if deltas:
+                _add(session, OrganizerWeek, {'organizer_email': organizer_email, 'week_start': week_start}, deltas)
+        for (organizer_email, week_start, response), count in self.responses.items():
+            if count:
+                _add(session, OrganizerWeekResponse,
+                     {'organizer_email': organizer_email, 'week_start': week_start, 'response': response},
+                     {'count': count})
+        self.meetings.clear()
+        self.responses.clear()
+        self._moved.clear()
+
+
+def _add(session: Session, model, key: Dict, deltas: Dict) -> None:
+    updated = session.query(model).filter_by(**key).update(
+        {getattr(model, column): getattr(model, column) + delta for column, delta in deltas.items()},
+        synchronize_session=False
+    )
+    if not updated:
+        session.add(model(**key, **deltas))
+        session.flush()
+
+
+def record_survey_response(session: Session, event_id: int, response: str,
+                           previous_response: Optional[str] = None) -> None:
+    """ Count a new or changed response in its organizer's week. Doesn't commit, see src.tallies.record_response. """
+    event = session.query(Event.organizer_email, Event.start_datetime).filter(Event.id == event_id).one()
+    batch = RollupBatch()
+    if previous_response:
+        batch.add_responses(event.organizer_email, event.start_datetime, previous_response, -1)
+    batch.add_responses(event.organizer_email, event.start_datetime, response)
+    batch.apply(session)
+
+
+def _summarize(totals: Dict, responses: Dict[str, int]) -> Dict:
+    answered = sum(responses.values())
+    return {
+        'meetings': totals.get('meetings') or 0,
+        'hours': round((totals.get('minutes') or 0) / 60, 1),
+        'cost': round(totals.get('cost') or 0, 2),
+        'undescribed_meetings': totals.get('undescribed_meetings') or 0,
+        'responses': {response: count for response, count in responses.items() if count},
+        'effectiveness': round(responses.get(EFFECTIVE_RESPONSE, 0) / answered, 3) if answered else None,
+    }
+
+
+def report_range(since: Optional[str] = None, until: Optional[str] = None) -> Tuple[date, date]:
+    """
+    Parse a report's ISO date range, rounded out to whole weeks. Defaults to the last REPORT_WEEKS weeks including
+    this one. Raises ValueError for dates which don't parse.
+    """
+    until_date = week_of(date.fromisoformat(until) - timedelta(days=1)) if until else week_of(datetime.utcnow())
+    until_date += timedelta(weeks=1)
+    since_date = week_of(date.fromisoformat(since)) if since else until_date - timedelta(weeks=REPORT_WEEKS)
+    return since_date, until_date
+
+
+def organizer_report(session: Session, organizer_email: str, since: date, until: date) -> Dict:
+    """ An organizer's digest: their totals over [since, until), and week by week. """
+    organizer_email = organizer_email.lower()
+    weeks = {}
+    for row in session.query(OrganizerWeek).filter(
+        OrganizerWeek.organizer_email == organizer_email,
+        OrganizerWeek.week_start >= since,
+        OrganizerWeek.week_start < until,
+    ):
+        weeks[row.week_start] = ({column: getattr(row, column) for column in MEETING_TOTALS}, Counter())
+    for week_start, response, count in session.query(
+        OrganizerWeekResponse.week_start, OrganizerWeekResponse.response, OrganizerWeekResponse.count
+    ).filter(
+        OrganizerWeekResponse.organizer_email == organizer_email,
+        OrganizerWeekResponse.week_start >= since,
+        OrganizerWeekResponse.week_start < until,
+    ):
+        weeks.setdefault(week_start, ({}, Counter()))[1][response] += count
+
+    totals, responses = Counter(), Counter()
+    for week_totals, week_responses in weeks.values():
+        totals.update(week_totals)
+        responses.update(week_responses)
+    return {
+        'organizer_email': organizer_email,
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        **_summarize(totals, responses),
+        'weeks': [{'week_start': week_start.isoformat(), **_summarize(*weeks[week_start])}
+                  for week_start in sorted(weeks)],
+    }
+
+
+def org_report(session: Session, since: date, until: date, limit: int = REPORT_ORGANIZERS) -> Dict:
+    """ Org-wide totals over [since, until), with the costliest organizers' totals. """
+    organizers = {}
+    for row in session.query(
+        OrganizerWeek.organizer_email, *[func.sum(getattr(OrganizerWeek, column)).label(column)
+                                         for column in MEETING_TOTALS]
+    ).filter(OrganizerWeek.week_start >= since, OrganizerWeek.week_start < until) \
+            .group_by(OrganizerWeek.organizer_email):
+        organizers[row.organizer_email] = ({column: getattr(row, column) for column in MEETING_TOTALS}, Counter())
+    for organizer_email, response, count in session.query(
+        OrganizerWeekResponse.organizer_email, OrganizerWeekResponse.response, func.sum(OrganizerWeekResponse.count)
+    ).filter(OrganizerWeekResponse.week_start >= since, OrganizerWeekResponse.week_start < until) \
+            .group_by(OrganizerWeekResponse.organizer_email, OrganizerWeekResponse.response):
+        organizers.setdefault(organizer_email, ({}, Counter()))[1][response] += count
+
+    totals, responses = Counter(), Counter()
+    for organizer_totals, organizer_responses in organizers.values():
+        totals.update(organizer_totals)
+        responses.update(organizer_responses)
+    costliest = sorted(organizers, key=lambda email: -(organizers[email][0].get('cost') or 0))[:limit]
+    return {
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        **_summarize(totals, responses),
+        'organizers': [{'organizer_email': email, **_summarize(*organizers[email])} for email in costliest],
+    }
+
+
+def backfill_event_stats(connection: Union[Connection, Session], batch_size: int = 1000) -> None:
+    """ Fill in the derived fields of events and archive summaries stored before they existed. Doesn't commit. """
+    for model, columns in [(Event, [Event.description]), (EventSummary, [])]:
+        table = model.__table__
+        id_column = table.primary_key.columns.values()[0]
+        last_id = 0
+        while True:
+            rows = connection.execute(
+                select(id_column, model.start_datetime, model.end_datetime, model.num_attendees, *columns)
+                .where(and_(id_column > last_id, model.duration_minutes.is_(None)))
+                .order_by(id_column).limit(batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            values = []
+            for row in rows:
+                if not row.start_datetime or not row.end_datetime:
+                    continue
+                stats = meeting_stats(row.start_datetime, row.end_datetime, row.num_attendees)
+                if model is Event:
+                    # Only Zoom meetings have ever been ingested.
+                    stats.update(description_stats(row.description, has_conference=True))
+                values.append({'_id': row[0], **stats})
+            if values:
+                connection.execute(table.update().where(id_column == bindparam('_id')), values)
+
+
+def rebuild_rollups(connection: Union[Connection, Session], fix: bool = True) -> List[Tuple]:
+    """
+    Recompute every organizer week from the events, archive summaries and tallies. Doesn't commit.
+    :param fix: Overwrite weeks which don't match, otherwise only report them
+    :return: (organizer email, week start) of the weeks which didn't match
+    """
+    batch = RollupBatch()
+    for model in (Event, EventSummary):
+        for row in connection.execute(select(*[getattr(model, column) for column in ROLLUP_COLUMNS])):
+            batch.add_event(row)
+    for row in connection.execute(
+        select(Event.organizer_email, Event.start_datetime, SurveyTally.response, SurveyTally.count)
+        .join_from(SurveyTally, Event, SurveyTally.event_id == Event.id)
+    ):
+        batch.add_responses(row.organizer_email, row.start_datetime, row.response, row.count)
+    for row in connection.execute(
+        select(EventSummary.organizer_email, EventSummary.start_datetime, EventSummary.responses)
+    ):
+        for response, count in (row.responses or {}).items():
+            batch.add_responses(row.organizer_email, row.start_datetime, response, count)
+
+    def comparable(totals: Dict) -> Dict:
+        # Costs summed in a different order differ in the last few bits.
+        return {k: round(v, 2) for k, v in totals.items() if round(v, 2)}
+
+    actual = defaultdict(dict)
+    for key, totals in batch.meetings.items():
+        actual[key]['totals'] = comparable(totals)
+    for (organizer_email, week_start, response), count in batch.responses.items():
+        actual[(organizer_email, week_start)].setdefault('responses', {})[response] = count
+    stored = defaultdict(dict)
+    for row in connection.execute(select(OrganizerWeek.__table__)):
+        stored[(row.organizer_email, row.week_start)]['totals'] = \
+            comparable({column: getattr(row, column) for column in MEETING_TOTALS})
+    for row in connection.execute(select(OrganizerWeekResponse.__table__)):
+        stored[(row.organizer_email, row.week_start)].setdefault('responses', {})[row.response] = row.count
+
+    def normalized(week: Dict) -> Dict:
+        responses = {response: count for response, count in week.get('responses', {}).items() if count}
+        return {'totals': week.get('totals', {}), 'responses': responses}
+
+    mismatched = sorted(key for key in actual.keys() | stored.keys()
+                        if normalized(actual.get(key, {})) != normalized(stored.get(key, {})))
+    if fix and mismatched:
+        for model in (OrganizerWeek, OrganizerWeekResponse):
+            table = model.__table__
+            connection.execute(
+                table.delete().where(and_(table.c.organizer_email == bindparam('_organizer_email'),
+                                          table.c.week_start == bindparam('_week_start'))),
+                [{'_organizer_email': email, '_week_start': week_start} for email, week_start in mismatched]
+            )
+        weeks = [{'organizer_email': email, 'week_start': week_start,
+                  **{column: batch.meetings[(email, week_start)].get(column, 0) for column in MEETING_TOTALS}}
+                 for email, week_start in mismatched if (email, week_start) in batch.meetings]
+        if weeks:
+            connection.execute(OrganizerWeek.__table__.insert(), weeks)
+        responses = [{'organizer_email': email, 'week_start': week_start, 'response': response, 'count': count}
+                     for email, week_start in mismatched
+                     for response, count in actual.get((email, week_start), {}).get('responses', {}).items()
+                     if count]
+        if responses:
+            connection.execute(OrganizerWeekResponse.__table__.insert(), responses)
+    return mismatched
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help="Only report mismatched weeks, don't fix them")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    session = get_session()
+    if not args.check:
+        backfill_event_stats(session)
+    mismatched = rebuild_rollups(session, fix=not args.check)
+    session.commit()
+    logging.info(f"{len(mismatched)} organizer weeks didn't match their events and responses"
+                 f"{'' if args.check else ' and were rebuilt'}: {mismatched}")
@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Dict, Iterable, Optional, Tuple
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from src.metrics import track_api_call
+from src.rate_limit import TokenBucket
+import logging
+import os
+import threading
+
+# Max number of Slack calls in flight at once.
+SLACK_CONCURRENCY = int(os.getenv('SLACK_CONCURRENCY', 8))
+# Max number of times a call is retried after Slack rate limits it.
+SLACK_MAX_RETRIES = int(os.getenv('SLACK_MAX_RETRIES', 5))
+
+# (calls per minute, burst size) per WebClient method across the workspace, based on Slack's rate limit tiers.
+METHOD_RATE_LIMITS: Dict[str, Tuple[float, int]] = {
+    'chat_postMessage': (600, 50),  # Special tier, several hundred a minute across the workspace
+    'users_list': (20, 3),  # Tier 2
+}
+DEFAULT_RATE_LIMIT = (20, 3)  # Tier 2, for methods we haven't classified
+# (calls per minute, burst size) per channel, for methods Slack also limits per channel. chat.postMessage is allowed
+# roughly one message per second per channel.
+CHANNEL_RATE_LIMITS: Dict[str, Tuple[float, int]] = {
+    'chat_postMessage': (60, 3),
+}
+
+
+class SlackDispatcher(object):
+    """
+    Sends Slack API calls from a bounded worker pool, pacing each method with its own token bucket, and each channel
+    too for methods in CHANNEL_RATE_LIMITS, and retrying calls which get rate limited after the Retry-After Slack sends
+    back.
+    """
+    def __init__(self, client: WebClient, max_workers: int = SLACK_CONCURRENCY, max_retries: int = SLACK_MAX_RETRIES):
+        self.client = client
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='slack')
+        self._buckets: Dict[str, TokenBucket] = {}
+        # (method, channel) -> bucket, one per channel we've messaged, i.e. at most one per user for DMs.
+        self._channel_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, method: str) -> TokenBucket:
+        with self._lock:
+            if method not in self._buckets:
+                self._buckets[method] = TokenBucket(*METHOD_RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))
+            return self._buckets[method]
+
+    def _channel_bucket(self, method: str, channel: Optional[str]) -> Optional[TokenBucket]:
+        if method not in CHANNEL_RATE_LIMITS or channel is None:
+            return None
+        with self._lock:
+            if (method, channel) not in self._channel_buckets:
+                self._channel_buckets[(method, channel)] = TokenBucket(*CHANNEL_RATE_LIMITS[method])
+            return self._channel_buckets[(method, channel)]
+
+    def call_now(self, method: str, **kwargs):
+        """ Make a rate limited call on the current thread and return the Slack response. """
+        bucket = self._bucket(method)
+        channel_bucket = self._channel_bucket(method, kwargs.get('channel'))
+        for attempt in range(self.max_retries + 1):
+            if channel_bucket:
+                channel_bucket.acquire()
+            bucket.acquire()
+            try:
+                with track_api_call('slack', method):
+                    return getattr(self.client, method)(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = int(e.response.headers.get('Retry-After', 1))
+                logging.info(f"Slack rate limited {method}, retrying in {retry_after}s.")
+                # A per-channel limit only holds back that channel, not every other message.
+                (channel_bucket or bucket).pause(retry_after)
+
+    def call(self, method: str, **kwargs) -> Future:
+        """ Queue a call on the worker pool. Failures are logged, call .result() on the future to handle them. """
+        def log_failure(f: Future) -> None:
+            if f.exception():
+                logging.error(f"Slack {method} failed: {f.exception()}")
+
+        future = self._executor.submit(self.call_now, method, **kwargs)
+        future.add_done_callback(log_failure)
+        return future
+
+    @staticmethod
+    def wait(futures: Iterable[Future], timeout: Optional[float] = None) -> None:
+        wait(list(futures), timeout=timeout)
+
+
+_dispatcher: Optional[SlackDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> SlackDispatcher:
+    """ The process-wide dispatcher, so every MeetingSurveyor shares the same pool and rate limits. """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = SlackDispatcher(WebClient(token=os.environ["SLACK_OAUTH_TOKEN"]))
+        return _dispatcher
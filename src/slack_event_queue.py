@@ -0,0 +1,85 @@
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Optional
+import logging
+import os
+import queue
+import threading
+
+# Number of threads processing Slack events.
+SLACK_EVENT_WORKERS = int(os.getenv('SLACK_EVENT_WORKERS', 4))
+# Max number of Slack events waiting to be processed before new ones are refused.
+SLACK_EVENT_QUEUE_SIZE = int(os.getenv('SLACK_EVENT_QUEUE_SIZE', 1000))
+# How many recent event ids are remembered to drop redeliveries.
+SLACK_EVENT_DEDUP_SIZE = 10000
+
+
+class SlackEventQueue(object):
+    """
+    Lets the Slack events endpoint ack straight away: events are deduplicated by event_id, queued, and handled by a
+    bounded pool of worker threads. Keeps ack latency and queue stats for monitoring.
+    """
+    def __init__(self, handler: Callable[[dict], None], workers: int = SLACK_EVENT_WORKERS,
+                 max_size: int = SLACK_EVENT_QUEUE_SIZE, dedup_size: int = SLACK_EVENT_DEDUP_SIZE):
+        self.handler = handler
+        self.dedup_size = dedup_size
+        self._queue = queue.Queue(maxsize=max_size)
+        self._seen = OrderedDict()  # Recently queued event ids, oldest first
+        self._ack_seconds = deque(maxlen=1000)
+        self._counts = {'queued': 0, 'processed': 0, 'failed': 0, 'duplicates': 0, 'retries': 0, 'rejected': 0}
+        self._lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f'slack-events-{i}', daemon=True).start()
+
+    def submit(self, event_data: dict, retry_num: Optional[str] = None) -> bool:
+        """
+        Queue an event unless we've already queued it.
+        :param retry_num: Slack's X-Slack-Retry-Num header, set when Slack is redelivering
+        :return: False if it was a duplicate
+        :raises queue.Full: if the queue is full, so the caller can fail the request and let Slack retry
+        """
+        event_id = event_data.get('event_id')
+        with self._lock:
+            if retry_num:
+                self._counts['retries'] += 1
+            if event_id and event_id in self._seen:
+                self._counts['duplicates'] += 1
+                return False
+            try:
+                self._queue.put_nowait(event_data)
+            except queue.Full:
+                self._counts['rejected'] += 1
+                raise
+            self._counts['queued'] += 1
+            if event_id:
+                self._seen[event_id] = True
+                while len(self._seen) > self.dedup_size:
+                    self._seen.popitem(last=False)
+        return True
+
+    def record_ack(self, seconds: float) -> None:
+        with self._lock:
+            self._ack_seconds.append(seconds)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            acks = sorted(self._ack_seconds)
+            return {
+                'queue_depth': self._queue.qsize(),
+                'ack_seconds_avg': sum(acks) / len(acks) if acks else None,
+                'ack_seconds_p99': acks[int(len(acks) * 0.99)] if acks else None,
+                'ack_seconds_max': acks[-1] if acks else None,
+                **self._counts,
+            }
+
+    def _work(self) -> None:
+        while True:
+            event_data = self._queue.get()
+            try:
+                self.handler(event_data)
+                outcome = 'processed'
+            except Exception:
+                logging.exception(f"Failed to handle Slack event {event_data.get('event_id')}.")
+                outcome = 'failed'
+            with self._lock:
+                self._counts[outcome] += 1
+            self._queue.task_done()
@@ -0,0 +1,83 @@
+"""
+Per-event survey tallies, updated in the same transaction as the SurveyResponse they count so that checking whether
+everyone has answered and building the results message don't have to load every response.
+
+Run this module to recompute the tallies from the raw responses, it reports any events which had drifted:
+
+    python3 -m src.tallies [--check]
+"""
+from collections import Counter
+from typing import Dict, List, Optional
+from sqlalchemy.orm import Session
+from db.database import get_session, SurveyResponse, SurveyTally
+from src.helpers import chunked, MAX_SQL_VARIABLES
+from src.rollups import record_survey_response
+import argparse
+import logging
+
+
+def _add(session: Session, event_id: int, response: str, delta: int) -> None:
+    updated = session.query(SurveyTally).filter_by(event_id=event_id, response=response).update(
+        {SurveyTally.count: SurveyTally.count + delta}, synchronize_session=False
+    )
+    if not updated:
+        session.add(SurveyTally(event_id=event_id, response=response, count=delta))
+        session.flush()
+
+
+def record_response(session: Session, event_id: int, response: str, previous_response: Optional[str] = None) -> None:
+    """
+    Count a new or changed response, in the event's tally and its organizer's weekly rollup. Doesn't commit, call it
+    alongside the SurveyResponse change.
+    """
+    if response == previous_response:
+        return
+    if previous_response:
+        _add(session, event_id, previous_response, -1)
+    _add(session, event_id, response, 1)
+    record_survey_response(session, event_id, response, previous_response)
+
+
+def get_tally(session: Session, event_id: int) -> Dict[str, int]:
+    """ Number of responses per answer for an event, most common first. """
+    rows = session.query(SurveyTally.response, SurveyTally.count).filter(
+        SurveyTally.event_id == event_id, SurveyTally.count > 0
+    ).order_by(SurveyTally.count.desc())
+    return dict(rows)
+
+
+def rebuild_tallies(session: Session, fix: bool = True) -> List[int]:
+    """
+    Recompute every event's tally from its SurveyResponses.
+    :param fix: Overwrite tallies which don't match, otherwise only report them
+    :return: Ids of the events whose tallies didn't match
+    """
+    actual = {}
+    for event_id, response in session.query(SurveyResponse.event_id, SurveyResponse.response).yield_per(10000):
+        actual.setdefault(event_id, Counter())[response] += 1
+    stored = {}
+    for event_id, response, count in session.query(SurveyTally.event_id, SurveyTally.response, SurveyTally.count):
+        if count:
+            stored.setdefault(event_id, Counter())[response] = count
+
+    mismatched = sorted(e for e in actual.keys() | stored.keys() if actual.get(e) != stored.get(e))
+    if fix:
+        for chunk in chunked(mismatched, MAX_SQL_VARIABLES):
+            session.query(SurveyTally).filter(SurveyTally.event_id.in_(chunk)).delete(synchronize_session=False)
+        session.bulk_insert_mappings(SurveyTally, [
+            {'event_id': event_id, 'response': response, 'count': count}
+            for event_id in mismatched for response, count in actual.get(event_id, {}).items()
+        ])
+        session.commit()
+    return mismatched
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help="Only report mismatched tallies, don't fix them")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    mismatched = rebuild_tallies(get_session(), fix=not args.check)
+    logging.info(f"{len(mismatched)} events had tallies which didn't match their responses"
+                 f"{'' if args.check else ' and were rebuilt'}: {mismatched}")
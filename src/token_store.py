@@ -0,0 +1,94 @@
+"""
+Google access tokens kept in the users table next to the refresh token, encrypted with TOKEN_ENCRYPTION_KEY, so a
+token refreshed by one process (or before a restart) is reused by the others until it expires instead of every
+process going back to Google's token endpoint.
+
+TOKEN_ENCRYPTION_KEY is one or more comma separated Fernet keys (generate one with
+`python3 -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"`). Tokens are encrypted
+with the first and decrypted with any of them, so a new key can be put in front of the old one to rotate it. Without a
+key nothing is persisted and tokens live only in each process's credentials cache.
+"""
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+import logging
+import os
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from sqlalchemy import and_, or_, update
+from db.database import get_engine, User
+from src.worker_leases import in_shards
+
+TOKEN_ENCRYPTION_KEY = os.getenv('TOKEN_ENCRYPTION_KEY')
+# Stored tokens with less than this left are treated as expired, the same margin the credentials cache uses.
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+# After a failed refresh (e.g. the user revoked access) the user's token is marked as expiring this far ahead, so they
+# aren't picked for pre-refresh again until it's within the pre-refresh window.
+TOKEN_RETRY_DELAY = timedelta(hours=1)
+
+
+class AccessTokenStore(object):
+    """ Reads and writes users' encrypted access tokens, each in its own short transaction so threads can use it. """
+    def __init__(self, keys: Optional[str] = TOKEN_ENCRYPTION_KEY):
+        self._fernet = MultiFernet([Fernet(key.strip()) for key in keys.split(',')]) if keys else None
+        if not self._fernet:
+            logging.warning("TOKEN_ENCRYPTION_KEY isn't set, Google access tokens won't be shared between processes.")
+
+    @property
+    def enabled(self) -> bool:
+        return self._fernet is not None
+
+    def load(self, user_id: int, refresh_token: str) -> Optional[Tuple[str, datetime]]:
+        """ :return: The user's stored (access token, expiry), if they have one that's good for a while longer """
+        if not self.enabled:
+            return None
+        with get_engine().connect() as connection:
+            row = connection.execute(
+                User.__table__.select().with_only_columns([User.access_token, User.access_token_expires_at])
+                .where(and_(User.id == user_id, User.refresh_token == refresh_token))
+            ).first()
+        if not row or not row.access_token or row.access_token_expires_at - TOKEN_EXPIRY_MARGIN <= datetime.utcnow():
+            return None
+        try:
+            return self._fernet.decrypt(row.access_token.encode()).decode(), row.access_token_expires_at
+        except InvalidToken:
+            return None  # Encrypted with a key we no longer have
+
+    def save(self, user_id: int, refresh_token: str, access_token: str, expiry: datetime) -> None:
+        """ Store a freshly refreshed token, unless the user has re-authorized with a new refresh token meanwhile. """
+        if self.enabled:
+            self._update(user_id, refresh_token, self._fernet.encrypt(access_token.encode()).decode(), expiry)
+
+    def record_failure(self, user_id: int, refresh_token: str) -> None:
+        """ Forget the user's token and hold off refreshing it ahead of time for TOKEN_RETRY_DELAY. """
+        if self.enabled:
+            self._update(user_id, refresh_token, None, datetime.utcnow() + TOKEN_RETRY_DELAY)
+
+    @staticmethod
+    def _update(user_id: int, refresh_token: str, access_token: Optional[str], expires_at: datetime) -> None:
+        with get_engine().begin() as connection:
+            connection.execute(
+                update(User.__table__)
+                .where(and_(User.id == user_id, User.refresh_token == refresh_token))
+                .values(access_token=access_token, access_token_expires_at=expires_at)
+            )
+
+    def due_for_refresh(self, session, window: timedelta, limit: int, shards: Optional[Iterable[int]] = None) \
+            -> List:
+        """
+        Connected users without a stored token or whose token expires within window, soonest first.
+        :return: Rows with the user's id and refresh_token
+        """
+        if not self.enabled:
+            return []
+        query = session.query(User.id, User.refresh_token).filter(
+            User.refresh_token.isnot(None),
+            User.is_deleted.is_(False),
+            or_(User.access_token_expires_at.is_(None), User.access_token_expires_at < datetime.utcnow() + window),
+        )
+        if shards is not None:
+            query = query.filter(in_shards(User.id, shards))
+        return query.order_by(User.access_token_expires_at).limit(limit).all()
+
+
+# Shared by everything in the process.
+token_store = AccessTokenStore()
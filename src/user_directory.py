@@ -0,0 +1,109 @@
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy.orm import Session
+from db.database import User
+from src.helpers import chunked, MAX_SQL_VARIABLES
+import os
+import threading
+import time
+
+# How long a cached user is trusted. Other processes' changes (e.g. an opt-out handled by the web process while the
+# scheduler sends surveys) are only seen once it expires.
+USER_CACHE_TTL_SECONDS = float(os.getenv('USER_CACHE_TTL_SECONDS', 60))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 20000))
+
+# Read-only copy of a users row. awaiting_response_on isn't included since it changes with every survey sent, read it
+# from the DB when it's needed.
+CachedUser = namedtuple('CachedUser', ['id', 'slack_id', 'email_address', 'has_opted_out', 'is_deleted',
+                                       'refresh_token'])
+_COLUMNS = [getattr(User, field) for field in CachedUser._fields]
+
+
+class UserDirectory(object):
+    """
+    Thread-safe read-through cache of users, looked up by id, slack_id or email address. Entries expire after a TTL,
+    the least recently used are evicted past max_size, and writers invalidate the users they change.
+    """
+    def __init__(self, ttl: float = USER_CACHE_TTL_SECONDS, max_size: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._users = OrderedDict()  # User id -> (expires at, CachedUser)
+        self._by_slack_id: Dict[str, int] = {}
+        self._by_email: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, user_id: Optional[int]) -> Optional[CachedUser]:
+        entry = self._users.get(user_id)
+        if not entry:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            self._remove(user_id)
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+    def _put(self, user: CachedUser) -> None:
+        self._remove(user.id)
+        self._users[user.id] = (time.monotonic() + self.ttl, user)
+        self._by_slack_id[user.slack_id] = user.id
+        self._by_email[user.email_address] = user.id
+        while len(self._users) > self.max_size:
+            self._remove(next(iter(self._users)))
+
+    def _remove(self, user_id: int) -> None:
+        entry = self._users.pop(user_id, None)
+        if entry:
+            _, user = entry
+            if self._by_slack_id.get(user.slack_id) == user_id:
+                del self._by_slack_id[user.slack_id]
+            if self._by_email.get(user.email_address) == user_id:
+                del self._by_email[user.email_address]
+
+    def _lookup(self, session: Session, column, keys: Iterable, index: Dict) -> List[CachedUser]:
+        found, missing = [], []
+        with self._lock:
+            for key in keys:
+                user = self._get(index.get(key))
+                if user:
+                    found.append(user)
+                else:
+                    missing.append(key)
+            self.hits += len(found)
+            self.misses += len(missing)
+        for chunk in chunked(missing, MAX_SQL_VARIABLES):
+            loaded = [CachedUser(*row) for row in session.query(*_COLUMNS).filter(column.in_(chunk))]
+            with self._lock:
+                for user in loaded:
+                    self._put(user)
+            found.extend(loaded)
+        return found
+
+    def get_by_id(self, session: Session, user_id: int) -> Optional[CachedUser]:
+        return next(iter(self._lookup(session, User.id, [user_id], {user_id: user_id})), None)
+
+    def get_by_slack_id(self, session: Session, slack_id: str) -> Optional[CachedUser]:
+        return next(iter(self._lookup(session, User.slack_id, [slack_id], self._by_slack_id)), None)
+
+    def get_by_email(self, session: Session, email_address: str) -> Optional[CachedUser]:
+        return next(iter(self._lookup(session, User.email_address, [email_address], self._by_email)), None)
+
+    def get_many_by_email(self, session: Session, email_addresses: Iterable[str]) -> List[CachedUser]:
+        """ Users for whichever of the emails we have, in one query for all the ones which aren't cached. """
+        return self._lookup(session, User.email_address, set(email_addresses), self._by_email)
+
+    def invalidate(self, user_ids: Optional[Iterable[int]] = None) -> None:
+        """ Drop the given users, or everyone, so they're re-read on next use. Call after committing changes. """
+        with self._lock:
+            for user_id in list(self._users) if user_ids is None else user_ids:
+                self._remove(user_id)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._users)}
+
+
+# Shared by everything in the process.
+user_directory = UserDirectory()
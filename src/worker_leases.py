@@ -0,0 +1,166 @@
+"""
+Splits the scheduler's work between however many scheduled.py processes are running. Users and events are divided
+into WORKER_SHARDS shards by id, and each shard is leased to one worker at a time through the worker_leases table.
+Workers heartbeat every LEASE_TTL / 3, renewing their leases and taking or giving up shards until each holds a fair
+share. A worker which dies stops renewing, so its shards expire and are picked up by the others.
+
+WORKER_SHARDS has to be the same for every worker sharing a database.
+"""
+from datetime import datetime, timedelta
+from math import ceil
+from typing import Callable, Iterable, Optional, Set
+from uuid import uuid4
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from db.database import get_session, remove_session, Worker, WorkerLease
+
+WORKER_SHARDS = int(os.getenv('WORKER_SHARDS', 64))
+# A worker which hasn't heartbeat for this long is assumed dead and its shards are given to the others.
+LEASE_TTL = timedelta(seconds=int(os.getenv('WORKER_LEASE_TTL_SECONDS', 60)))
+
+
+def shard_of(id_: int, num_shards: int = WORKER_SHARDS) -> int:
+    return id_ % num_shards
+
+
+def in_shards(column, shards: Iterable[int], num_shards: int = WORKER_SHARDS):
+    """ SQL criterion for rows whose id column falls in one of the shards. """
+    return (column % num_shards).in_(list(shards))
+
+
+class ShardLeases(object):
+    """
+    The shards this process currently owns. on_acquired is called with each set of newly acquired shards, from the
+    heartbeat thread, so their pending work can be picked up.
+    """
+    def __init__(self, num_shards: int = WORKER_SHARDS, ttl: timedelta = LEASE_TTL,
+                 on_acquired: Optional[Callable[[Set[int]], None]] = None):
+        self.num_shards = num_shards
+        self.ttl = ttl
+        self.on_acquired = on_acquired
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+        self.shards: Set[int] = set()
+        self._renewed_at = 0.0  # time.monotonic() of the last successful heartbeat
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def owned(self) -> Set[int]:
+        """ Our shards, or none if we haven't managed to renew them lately and they may have been taken over. """
+        with self._lock:
+            if time.monotonic() - self._renewed_at > self.ttl.total_seconds():
+                return set()
+            return set(self.shards)
+
+    def owns(self, id_: int) -> bool:
+        """ Whether the user or event with this id belongs to one of our shards. """
+        return shard_of(id_, self.num_shards) in self.owned()
+
+    def is_leader(self) -> bool:
+        """ Whether this worker should run the jobs which only one worker runs, i.e. it owns shard 0. """
+        return 0 in self.owned()
+
+    def _ensure_shards(self, session) -> None:
+        existing = {row.shard for row in session.query(WorkerLease.shard)}
+        missing = [{'shard': shard} for shard in range(self.num_shards) if shard not in existing]
+        if not missing:
+            return
+        try:
+            session.bulk_insert_mappings(WorkerLease, missing)
+            session.commit()
+        except IntegrityError:
+            session.rollback()  # Another worker got there first
+
+    def heartbeat(self) -> Set[int]:
+        """
+        Renew our leases, then claim free or expired shards up to our fair share, or release any beyond it.
+        :return: The shards we own now
+        """
+        session = get_session()
+        started = time.monotonic()
+        now = datetime.utcnow()
+        session.merge(Worker(id=self.worker_id, heartbeat_at=now))
+        session.query(Worker).filter(Worker.heartbeat_at < now - self.ttl).delete(synchronize_session=False)
+        fair_share = ceil(self.num_shards / max(1, session.query(Worker).count()))
+
+        mine = WorkerLease.owner == self.worker_id
+        session.query(WorkerLease).filter(mine, WorkerLease.expires_at >= now).update(
+            {WorkerLease.expires_at: now + self.ttl}, synchronize_session=False
+        )
+        owned = sorted(row.shard for row in session.query(WorkerLease.shard).filter(
+            mine, WorkerLease.expires_at >= now))
+
+        if len(owned) > fair_share:
+            extra = owned[fair_share:]
+            session.query(WorkerLease).filter(mine, WorkerLease.shard.in_(extra)).update(
+                {WorkerLease.owner: None, WorkerLease.expires_at: None}, synchronize_session=False
+            )
+            owned = owned[:fair_share]
+        elif len(owned) < fair_share:
+            claimable = or_(WorkerLease.owner.is_(None), WorkerLease.expires_at < now)
+            for row in session.query(WorkerLease.shard).filter(claimable).order_by(WorkerLease.shard) \
+                    .limit(fair_share - len(owned)).all():
+                # Conditional so only one of several workers claiming the same shard gets it.
+                claimed = session.query(WorkerLease).filter(WorkerLease.shard == row.shard, claimable).update(
+                    {WorkerLease.owner: self.worker_id, WorkerLease.expires_at: now + self.ttl},
+                    synchronize_session=False
+                )
+                if claimed:
+                    owned.append(row.shard)
+        session.commit()
+
+        with self._lock:
+            acquired = set(owned) - self.shards
+            released = self.shards - set(owned)
+            self.shards = set(owned)
+            self._renewed_at = started
+        if acquired or released:
+            logging.info(f"Worker {self.worker_id} acquired shards {sorted(acquired)}, released {sorted(released)}, "
+                         f"now owns {len(owned)} of {self.num_shards}.")
+        if acquired and self.on_acquired:
+            self.on_acquired(acquired)
+        return set(owned)
+
+    def release(self) -> None:
+        """ Give up all our shards and deregister, so other workers can take over without waiting for expiry. """
+        session = get_session()
+        try:
+            session.query(WorkerLease).filter(WorkerLease.owner == self.worker_id).update(
+                {WorkerLease.owner: None, WorkerLease.expires_at: None}, synchronize_session=False
+            )
+            session.query(Worker).filter_by(id=self.worker_id).delete(synchronize_session=False)
+            session.commit()
+            with self._lock:
+                self.shards = set()
+        finally:
+            remove_session()
+
+    def start(self) -> None:
+        """ Take our first shards now, then heartbeat in a background thread, releasing everything on exit. """
+        if self._thread:
+            return
+        try:
+            self._ensure_shards(get_session())
+            self.heartbeat()
+        finally:
+            remove_session()
+
+        def run():
+            while True:
+                time.sleep(self.ttl.total_seconds() / 3)
+                try:
+                    self.heartbeat()
+                except Exception:
+                    logging.exception("Worker heartbeat failed.")
+                finally:
+                    remove_session()
+
+        self._thread = threading.Thread(target=run, name='worker-leases', daemon=True)
+        self._thread.start()
+        atexit.register(self.release)